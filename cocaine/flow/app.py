@@ -20,13 +20,12 @@
 #
 
 import logging
-from multiprocessing.pool import ThreadPool
 
 import tornado.web
-from tornado.ioloop import IOLoop
 
 from cocaine.flow.handlers import apps
 from cocaine.flow.handlers import auth
+from cocaine.flow.handlers import batch
 from cocaine.flow.handlers import buildlogs
 from cocaine.flow.handlers import crashlogs
 from cocaine.flow.handlers import groups
@@ -34,11 +33,27 @@ from cocaine.flow.handlers import hosts
 from cocaine.flow.handlers import profiles
 from cocaine.flow.handlers import runlists
 from cocaine.flow.handlers import utils
-
+from cocaine.flow.handlers import DEFAULT_FLUSH_INTERVAL
+from cocaine.flow.handlers import DEFAULT_FLUSH_SIZE
+from cocaine.flow.handlers import StreamingHandler
+
+from cocaine.flow.encoding import DEFAULT_JSON_ENCODER
+from cocaine.flow.encoding import LargeBodyGZipEncoding
+from cocaine.flow.encoding import ResponseEncoder
+from cocaine.flow.executor import Executor
+from cocaine.flow.executor import DEFAULT_POOLS
+from cocaine.flow.executor import DEFAULT_RETRY_AFTER
+from cocaine.flow.executor import UNPACK
 from cocaine.flow.flowcloud import FlowCloud
+from cocaine.flow.flowcloud import DEFAULT_CACHE_SIZE
+from cocaine.flow.flowcloud import DEFAULT_CACHE_TTL
+from cocaine.flow.flowcloud import DEFAULT_POOL_SIZE
+from cocaine.flow.flowcloud import LEAST_INFLIGHT
 from cocaine.flow.flowcloud import FlowTools
 from cocaine.flow.flowcloud import AppUploadInfo
+from cocaine.flow.metrics import registry
 from cocaine.flow.token import Token
+from cocaine.flow.token import TOKEN_CACHE_SIZE
 
 
 class FlowInitializationError(Exception):
@@ -67,6 +82,8 @@ class FlowRestServer(tornado.web.Application):
 
             (r"/flow/v1/crashlogs/([^/]+)", crashlogs.CrashlogsList),
             (r"/flow/v1/crashlogs/([^/]+)/([^/]+)", crashlogs.Crashlogs),
+            (r"/flow/v1/crashstats/?", crashlogs.CrashStatsTop),
+            (r"/flow/v1/crashstats/([^/]+)", crashlogs.CrashStats),
 
             (r"/flow/v1/buildlogs/", buildlogs.BuildlogsList),
             (r"/flow/v1/buildlogs/(.+)", buildlogs.Buildlogs),
@@ -83,13 +100,18 @@ class FlowRestServer(tornado.web.Application):
             (r"/flow/v1/stopapp/(?P<app>.+)/(?P<version>.+)", apps.AppStop),
             (r"/flow/v1/deployapp/(?P<app>.+)/(?P<version>.+)", apps.AppDeploy),
 
+            (r"/flow/v1/batch", batch.Batch),
+
+            (r"/flow/v1/metrics", utils.Metrics),
             (r"/flow/v1/status", utils.Status),
             (r"/flow/v1/ping", utils.Ping),
         ]
         self.docker = settings['docker']
         self.registry = settings['registry']
 
-        self.cipher = Token(settings['cookie_secret'])
+        self.cipher = Token(settings['cookie_secret'],
+                            cache_size=settings.get('token_cache_size',
+                                                    TOKEN_CACHE_SIZE))
         cocaine_host = settings['cocaine_host']
         cocaine_port = settings['cocaine_port']
 
@@ -97,16 +119,68 @@ class FlowRestServer(tornado.web.Application):
                          cocaine_host, cocaine_port)
         AppUploadInfo.configure(docker=self.docker,
                                 registry=self.registry)
+        FlowCloud.configure_cache(settings.get('cache_ttl', DEFAULT_CACHE_TTL),
+                                  settings.get('cache_size', DEFAULT_CACHE_SIZE))
         try:
-            FlowTools.instance(host=cocaine_host, port=cocaine_port)
+            FlowTools.instance(host=cocaine_host, port=cocaine_port,
+                               size=settings.get('flow_tools_pool_size',
+                                                 DEFAULT_POOL_SIZE),
+                               policy=settings.get('flow_tools_balancing',
+                                                   LEAST_INFLIGHT))
         except Exception as err:  # todo: check other exc types
             self.logger.error("Unable to connect to flow-tools application")
             raise FlowInitializationError("flow-tools is unavailable %s" % err)
 
-        # thread pool for blocking operations
-        self._pool = ThreadPool(10)
-
-        tornado.web.Application.__init__(self, handlers, **settings)
+        # bounded pools for blocking operations
+        self.executor = Executor(settings.get('executor_pools', DEFAULT_POOLS),
+                                 settings.get('executor_retry_after',
+                                              DEFAULT_RETRY_AFTER))
+        self.register_metrics()
+
+        ResponseEncoder.configure(settings.get('json_encoder',
+                                               DEFAULT_JSON_ENCODER))
+        StreamingHandler.configure_streaming(
+            settings.get('stream_flush_size', DEFAULT_FLUSH_SIZE),
+            settings.get('stream_flush_interval', DEFAULT_FLUSH_INTERVAL))
+        transforms = list()
+        if settings.get('compress_response', True):
+            transforms.append(LargeBodyGZipEncoding)
+
+        tornado.web.Application.__init__(self, handlers,
+                                         transforms=transforms, **settings)
+
+    def register_metrics(self):
+        def pools(attr):
+            return lambda: dict(((("pool", name),), getattr(pool, attr))
+                                for name, pool in self.executor.pools.items())
+
+        def connections():
+            conns = FlowTools.instance().connections
+            return dict(((("connection", str(i)),), conn.inflight)
+                        for i, conn in enumerate(conns))
+
+        registry.gauge("flow_executor_queue_depth",
+                       "tasks waiting for a worker", pools("queued"))
+        registry.gauge("flow_executor_pending",
+                       "tasks queued or running", pools("pending"))
+        registry.counter("flow_executor_rejected_total",
+                         "tasks rejected due to the full queue",
+                         pools("rejected"))
+        registry.gauge("flow_tools_inflight",
+                       "flow-tools requests in flight by connection",
+                       connections)
+        registry.counter("flow_cache_hits_total",
+                         "response cache hits",
+                         lambda: {(): FlowCloud.cache.hits})
+        registry.counter("flow_cache_misses_total",
+                         "response cache misses",
+                         lambda: {(): FlowCloud.cache.misses})
+        registry.counter("flow_token_cache_hits_total",
+                         "token cache hits",
+                         lambda: {(): self.cipher.hits})
+        registry.counter("flow_token_cache_misses_total",
+                         "token cache misses",
+                         lambda: {(): self.cipher.misses})
 
     def guest(self):
         return FlowCloud.guest()
@@ -114,9 +188,11 @@ class FlowRestServer(tornado.web.Application):
     def authorized(self, user_info):
         return FlowCloud.authorized(user_info)
 
-    def run_background(self, func, callback):
-        self.logger.debug("Apply %s", func)
+    def check_background(self, work_class=UNPACK):
+        # raises ExecutorOverloaded if the queue of the pool is full
+        self.executor.check(work_class)
 
-        def _callback(result):
-            IOLoop.instance().add_callback(lambda: callback(result))
-        self._pool.apply_async(func, (), {}, _callback)
+    def run_background(self, func, callback, work_class=UNPACK):
+        # raises ExecutorOverloaded if the queue of the pool is full
+        self.logger.debug("Apply %s in %s pool", func, work_class)
+        self.executor.submit(work_class, func, callback)
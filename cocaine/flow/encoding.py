@@ -0,0 +1,73 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import importlib
+import json
+import logging
+
+import msgpack
+from tornado.web import GZipContentEncoding
+
+
+JSON = "application/json"
+MSGPACK = "application/x-msgpack"
+
+DEFAULT_JSON_ENCODER = "json"
+# responses shorter than this aren't worth compressing
+GZIP_MIN_LENGTH = 1024
+
+logger = logging.getLogger("tornado.application")
+
+
+class ResponseEncoder(object):
+    json_encoder = DEFAULT_JSON_ENCODER
+    json_dumps = staticmethod(json.dumps)
+
+    @classmethod
+    def configure(cls, json_encoder=DEFAULT_JSON_ENCODER):
+        """Use dumps() of a given module (e.g. ujson) to encode JSON"""
+        try:
+            module = importlib.import_module(json_encoder)
+            cls.json_dumps = staticmethod(module.dumps)
+            cls.json_encoder = json_encoder
+        except (ImportError, AttributeError) as err:
+            logger.warning("Unable to use %s as JSON encoder: %s. "
+                           "Fall back to json", json_encoder, err)
+            cls.json_dumps = staticmethod(json.dumps)
+            cls.json_encoder = DEFAULT_JSON_ENCODER
+
+    @classmethod
+    def negotiate(cls, accept):
+        """Return (format, content type, encode function) for Accept header"""
+        if accept and MSGPACK in accept:
+            return "msgpack", MSGPACK, msgpack.packb
+        return cls.json_encoder, JSON, cls.json_dumps
+
+
+class LargeBodyGZipEncoding(GZipContentEncoding):
+    MIN_LENGTH = GZIP_MIN_LENGTH
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        # Content-Range and Content-Length of a part count plain bytes
+        if "Content-Range" in headers:
+            self._gzipping = False
+        return super(LargeBodyGZipEncoding, self).transform_first_chunk(
+            status_code, headers, chunk, finishing)
@@ -0,0 +1,172 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from tornado.ioloop import IOLoop
+
+from cocaine.flow.metrics import Histogram
+
+# work classes
+UNPACK = "unpack"
+CLEANUP = "cleanup"
+
+# <work class>:thread:<workers>:<max queue depth>
+DEFAULT_POOLS = (
+    "unpack:thread:4:32",
+    "cleanup:thread:2:256",
+)
+DEFAULT_RETRY_AFTER = 5  # seconds
+
+POOL_TYPES = {
+    "thread": ThreadPool,
+}
+
+logger = logging.getLogger("tornado.application")
+
+
+class ExecutorOverloaded(Exception):
+    def __init__(self, work_class, retry_after):
+        super(ExecutorOverloaded, self).__init__(
+            "Queue of %s pool is full" % work_class)
+        self.work_class = work_class
+        self.retry_after = retry_after
+
+
+def parse_pool_spec(spec):
+    try:
+        name, kind, workers, max_queue = spec.split(":")
+        return name, kind, int(workers), int(max_queue)
+    except ValueError:
+        raise ValueError("Invalid pool specification %s" % spec)
+
+
+def _timed_call(func):
+    # executed inside a worker, so it should be a module level function
+    started = time.time()
+    try:
+        result = func()
+    except Exception as err:
+        return False, err, started, time.time()
+    return True, result, started, time.time()
+
+
+class WorkerPool(object):
+    def __init__(self, name, kind, workers, max_queue):
+        if kind not in POOL_TYPES:
+            raise ValueError("Unknown pool type %s" % kind)
+        self.name = name
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pool = POOL_TYPES[kind](workers)
+
+        # tasks which have been submitted, but aren't finished yet
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.queue_wait = Histogram()
+        self.run_time = Histogram()
+
+    @property
+    def queued(self):
+        return max(0, self.pending - self.workers)
+
+    def check(self, retry_after=DEFAULT_RETRY_AFTER):
+        if self.pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise ExecutorOverloaded(self.name, retry_after)
+
+    def submit(self, func, callback, retry_after=DEFAULT_RETRY_AFTER):
+        self.check(retry_after)
+        self.pending += 1
+        submitted = time.time()
+        io_loop = IOLoop.current()
+
+        def _callback(res):
+            io_loop.add_callback(partial(self._done, submitted, callback, res))
+        self._pool.apply_async(_timed_call, (func,), {}, _callback)
+
+    def _done(self, submitted, callback, res):
+        ok, result, started, finished = res
+        self.pending -= 1
+        self.queue_wait.observe(started - submitted)
+        self.run_time.observe(finished - started)
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+            logger.error("Task in %s pool failed: %s", self.name, result)
+            result = None
+        callback(result)
+
+    def stats(self):
+        return {
+            "type": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "pending": self.pending,
+            "queued": self.queued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "queue_wait": self.queue_wait.dump(),
+            "run_time": self.run_time.dump(),
+        }
+
+    def close(self):
+        self._pool.terminate()
+
+
+class Executor(object):
+    """Set of bounded worker pools, one per class of blocking work"""
+    def __init__(self, pools=DEFAULT_POOLS, retry_after=DEFAULT_RETRY_AFTER):
+        self.retry_after = retry_after
+        self.pools = dict()
+        for spec in pools:
+            name, kind, workers, max_queue = parse_pool_spec(spec)
+            self.pools[name] = WorkerPool(name, kind, workers, max_queue)
+
+    def _pool(self, work_class):
+        try:
+            return self.pools[work_class]
+        except KeyError:
+            raise ValueError("Unknown work class %s" % work_class)
+
+    def check(self, work_class):
+        # raises ExecutorOverloaded if a task of work_class
+        # would be rejected now
+        self._pool(work_class).check(self.retry_after)
+
+    def submit(self, work_class, func, callback):
+        self._pool(work_class).submit(func, callback, self.retry_after)
+
+    def stats(self):
+        return dict((name, pool.stats())
+                    for name, pool in self.pools.items())
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
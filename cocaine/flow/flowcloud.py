@@ -18,15 +18,85 @@
 #    You should have received a copy of the GNU Lesser General Public License
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
+import hashlib
+import logging
 import threading
+import time
+from collections import OrderedDict
+from functools import partial
 
 import msgpack
 from tornado.concurrent import Future
+from tornado.escape import utf8
+from tornado.ioloop import PeriodicCallback
 from cocaine.exceptions import ChokeEvent
 
+from cocaine.flow.metrics import registry
+
 
 null_arg = msgpack.packb(None)
 
+logger = logging.getLogger("tornado.application")
+
+DEFAULT_POOL_SIZE = 4
+RECONNECT_INTERVAL = 5  # seconds
+ROUND_ROBIN = "round-robin"
+LEAST_INFLIGHT = "least-inflight"
+
+DEFAULT_CACHE_TTL = 5  # seconds
+DEFAULT_CACHE_SIZE = 1024
+
+# results of these methods are cached in a given namespace
+CACHEABLE_METHODS = {
+    "profile-list": "profiles",
+    "profile-read": "profiles",
+    "runlist-list": "runlists",
+    "runlist-read": "runlists",
+    "group-list": "groups",
+    "group-read": "groups",
+    "host-list": "hosts",
+}
+
+# identical concurrent calls of these methods share one request
+READONLY_METHODS = frozenset(list(CACHEABLE_METHODS) + [
+    "crashlog-list",
+    "crashlog-view",
+    "crashlog-query",
+    "crashlog-top",
+    "crashlog-rate",
+    "user-app-list",
+    "user-buildlog-list",
+    "user-buildlog-read",
+    "app-info",
+    "host-health",
+])
+
+# FlowCloud methods which may be called through the batch API
+BATCH_METHODS = frozenset([
+    "profile_list", "profile_read", "profile_upload", "profile_remove",
+    "host_list", "host_health", "host_add", "host_remove",
+    "runlist_list", "runlist_read", "runlist_remove",
+    "group_list", "group_read", "group_create", "group_remove",
+    "group_pushapp", "group_popapp", "group_refresh",
+    "crashlog_list", "crashlog_view", "crashlog_query",
+    "crashlog_top", "crashlog_rate",
+    "app_list", "app_info",
+])
+
+# namespaces which become stale after a given method
+INVALIDATING_METHODS = {
+    "profile-upload": ("profiles",),
+    "profile-remove": ("profiles",),
+    "runlist-remove": ("runlists",),
+    "group-create": ("groups",),
+    "group-remove": ("groups",),
+    "group-pushapp": ("groups",),
+    "group-popapp": ("groups",),
+    "host-add": ("hosts",),
+    "host-remove": ("hosts",),
+    "app-deploy": ("groups", "runlists"),
+}
+
 
 class PermissionDenied(Exception):
     pass
@@ -76,22 +146,223 @@ def convert_future(cocaine_future):
     return future
 
 
+def content_hash(body):
+    return '"%s"' % hashlib.sha1(utf8(body)).hexdigest()
+
+
+class ResponseCache(object):
+    """LRU cache of flow-tools responses with TTL.
+
+    Entries are grouped into namespaces, which are dropped entirely
+    by invalidate(). Every process has its own cache, so the TTL
+    bounds the staleness after changes made by other processes.
+
+    Serialized forms of cached values are kept along with them,
+    so an unchanged value is encoded and hashed only once.
+    """
+    def __init__(self, ttl=DEFAULT_CACHE_TTL, size=DEFAULT_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        # key -> (namespace, expiration time, value, {format: (body, etag)})
+        self._items = OrderedDict()
+        # id of cached value -> key
+        self._owners = dict()
+        # namespace -> number of invalidations
+        self._generations = dict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.size > 0
+
+    def get(self, key):
+        item = self._items.pop(key, None)
+        if item is None or item[1] < time.time():
+            if item is not None:
+                self._owners.pop(id(item[2]), None)
+            self.misses += 1
+            return False, None
+
+        # move to the end as the most recently used
+        self._items[key] = item
+        self.hits += 1
+        return True, item[2]
+
+    def generation(self, namespace):
+        return self._generations.get(namespace, 0)
+
+    def put(self, key, namespace, value, generation):
+        # result could be obtained before the namespace was invalidated
+        if generation != self.generation(namespace):
+            return
+
+        self._drop(key)
+        self._items[key] = (namespace, time.time() + self.ttl, value, dict())
+        self._owners[id(value)] = key
+        while len(self._items) > self.size:
+            self._drop(next(iter(self._items)))
+            self.evictions += 1
+
+    def invalidate(self, namespace):
+        self._generations[namespace] = self.generation(namespace) + 1
+        stale = [key for key, item in self._items.items()
+                 if item[0] == namespace]
+        for key in stale:
+            self._drop(key)
+
+    def serialized(self, value, fmt, encode):
+        """Return (body, etag) of the value encoded in a given format"""
+        item = self._items.get(self._owners.get(id(value)))
+        # cached item holds the value, so its id can't be reused
+        if item is None or item[2] is not value:
+            body = encode(value)
+            return body, content_hash(body)
+
+        memo = item[3]
+        if fmt not in memo:
+            body = encode(value)
+            memo[fmt] = (body, content_hash(body))
+        return memo[fmt]
+
+    def _drop(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._owners.pop(id(item[2]), None)
+
+    def stats(self):
+        return {
+            "ttl": self.ttl,
+            "size": self.size,
+            "items": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class FlowToolsConnection(object):
+    def __init__(self, host, port):
+        from cocaine.services import Service
+        self.service = Service("flow-tools", host=host, port=port)
+        self.inflight = 0
+        self.reconnecting = False
+
+    def connected(self):
+        return self.service.isConnected()
+
+    def enqueue(self, method, packed_args):
+        stream = self.service.enqueue(method, packed_args)
+        self.inflight += 1
+        finished = list()
+
+        def track(result):
+            # pass chunks through, the stream is over on choke or error
+            try:
+                return result.get()
+            except Exception:
+                if not finished:
+                    finished.append(True)
+                    self.inflight -= 1
+                raise
+
+        return stream.then(track)
+
+    def reconnect(self):
+        if self.reconnecting:
+            return
+
+        def on_done(result):
+            self.reconnecting = False
+            try:
+                result.get()
+            except Exception as err:
+                logger.error("Unable to reconnect to flow-tools: %s", err)
+
+        self.reconnecting = True
+        try:
+            self.service.reconnect().then(on_done)
+        except Exception as err:
+            self.reconnecting = False
+            logger.error("Unable to reconnect to flow-tools: %s", err)
+
+    def stats(self):
+        return {
+            "connected": self.connected(),
+            "inflight": self.inflight,
+        }
+
+
+class FlowToolsPool(object):
+    """Set of connections to flow-tools.
+
+    It has the same enqueue() as a Service, but spreads requests
+    among its connections and reconnects broken ones in background.
+    """
+    def __init__(self, host, port, size=DEFAULT_POOL_SIZE,
+                 policy=LEAST_INFLIGHT):
+        if policy not in (ROUND_ROBIN, LEAST_INFLIGHT):
+            raise ValueError("Unknown balancing policy %s" % policy)
+        self.policy = policy
+        self.connections = [FlowToolsConnection(host, port)
+                            for _ in range(max(1, size))]
+        self._next = 0
+        self._watcher = PeriodicCallback(self.check_connections,
+                                         RECONNECT_INTERVAL * 1000)
+        self._watcher.start()
+
+    def pick(self):
+        alive = [conn for conn in self.connections if conn.connected()]
+        # a service reconnects itself on demand, so
+        # use any connection if all of them are broken
+        candidates = alive or self.connections
+        if self.policy == LEAST_INFLIGHT:
+            return min(candidates, key=lambda conn: conn.inflight)
+
+        self._next = (self._next + 1) % len(candidates)
+        return candidates[self._next]
+
+    def enqueue(self, method, packed_args):
+        return self.pick().enqueue(method, packed_args)
+
+    def check_connections(self):
+        for conn in self.connections:
+            if not conn.connected():
+                conn.reconnect()
+
+    def stats(self):
+        return {
+            "policy": self.policy,
+            "connections": [conn.stats() for conn in self.connections],
+        }
+
+
 class FlowTools(object):
     _instance_lock = threading.Lock()
 
     @staticmethod
-    def instance(host="localhost", port=10053):
+    def instance(host="localhost", port=10053,
+                 size=DEFAULT_POOL_SIZE, policy=LEAST_INFLIGHT):
         if not hasattr(FlowTools, "_instance"):
             with FlowTools._instance_lock:
                 if not hasattr(FlowTools, "_instance"):
-                    from cocaine.services import Service
-                    FlowTools._instance = Service("flow-tools",
-                                                  host=host,
-                                                  port=port)
+                    FlowTools._instance = FlowToolsPool(host, port,
+                                                        size, policy)
         return FlowTools._instance
 
 
 class FlowCloud(object):
+    cache = ResponseCache()
+    # (method, packed args) -> future of the request in flight
+    inflight = dict()
+    coalesced = 0
+
+    @classmethod
+    def configure_cache(cls, ttl, size):
+        cls.cache = ResponseCache(ttl, size)
+
     def __init__(self, user_info):
         self.app = FlowTools.instance()
         self.user_info = user_info
@@ -110,12 +381,106 @@ class FlowCloud(object):
 
     def enqueue(self, method, *args):
         packed_args = msgpack.packb(*args) if args else null_arg
-        return convert_future(self.app.enqueue(method,
-                                               packed_args))
+        namespace = CACHEABLE_METHODS.get(method)
+        if namespace is not None and self.cache.enabled:
+            return self._cached_enqueue(method, packed_args, namespace)
+
+        if method in READONLY_METHODS:
+            future, _ = self._shared_enqueue(method, packed_args)
+            return future
+
+        self._invalidate(method)
+        future = self._send(method, packed_args)
+        if method in INVALIDATING_METHODS:
+            # drop results which have been read during the change
+            future.add_done_callback(lambda _: self._invalidate(method))
+        return future
 
     def stream_enqueue(self, method, *args):
         packed_args = msgpack.packb(*args) if args else null_arg
-        return self.app.enqueue(method, packed_args)
+        self._invalidate(method)
+        registry.inc("flow_tools_calls_total",
+                     (("method", method), ("result", "stream")))
+        stream = self.app.enqueue(method, packed_args)
+        if method not in INVALIDATING_METHODS:
+            return stream
+
+        def invalidate(result):
+            # drop results which have been read during the stream,
+            # it's over on choke or error
+            try:
+                return result.get()
+            except Exception:
+                self._invalidate(method)
+                raise
+        return stream.then(invalidate)
+
+    def _send(self, method, packed_args):
+        started = time.time()
+        future = convert_future(self.app.enqueue(method,
+                                                 packed_args))
+
+        def account(future):
+            result = "ok" if future.exception() is None else "error"
+            registry.inc("flow_tools_calls_total",
+                         (("method", method), ("result", result)))
+            registry.observe("flow_tools_call_duration_seconds",
+                             time.time() - started,
+                             (("method", method),))
+        future.add_done_callback(account)
+        return future
+
+    def _cached_enqueue(self, method, packed_args, namespace):
+        key = (method, packed_args)
+        found, value = self.cache.get(key)
+        if found:
+            future = Future()
+            future.set_result(value)
+            return future
+
+        generation = self.cache.generation(namespace)
+        future, created = self._shared_enqueue(method, packed_args)
+        if created:
+            future.add_done_callback(partial(self._store, key,
+                                             namespace, generation))
+        return future
+
+    def _shared_enqueue(self, method, packed_args):
+        key = (method, packed_args)
+        future = self.inflight.get(key)
+        if future is not None:
+            FlowCloud.coalesced += 1
+            return future, False
+
+        future = self._send(method, packed_args)
+        self.inflight[key] = future
+        future.add_done_callback(partial(self._forget, key))
+        return future, True
+
+    def _forget(self, key, future):
+        # the key could be already taken by a newer request
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+
+    def _store(self, key, namespace, generation, future):
+        if future.exception() is None:
+            self.cache.put(key, namespace, future.result(), generation)
+
+    @classmethod
+    def inflight_stats(cls):
+        return {
+            "inflight": len(cls.inflight),
+            "coalesced": cls.coalesced,
+        }
+
+    def _invalidate(self, method):
+        for namespace in INVALIDATING_METHODS.get(method, ()):
+            self.cache.invalidate(namespace)
+            # don't attach new readers to requests sent before the change
+            stale = [key for key in self.inflight
+                     if CACHEABLE_METHODS.get(key[0]) == namespace]
+            for key in stale:
+                del self.inflight[key]
 
     # profiles
     def profile_list(self):
@@ -138,6 +503,9 @@ class FlowCloud(object):
     def host_list(self):
         return self.enqueue("host-list")
 
+    def host_health(self):
+        return self.enqueue("host-health")
+
     def host_add(self, name):
         return self.enqueue("host-add", name)
 
@@ -182,8 +550,9 @@ class FlowCloud(object):
         }
         return self.enqueue("group-popapp", task)
 
-    def group_refresh(self, name):
-        return self.enqueue("group-refresh", name)
+    def group_refresh(self, names):
+        # name of the group or list of names
+        return self.enqueue("group-refresh", names)
 
     # crashlogs
     def crashlog_list(self, name):
@@ -196,6 +565,42 @@ class FlowCloud(object):
         }
         return self.enqueue("crashlog-view", task)
 
+    def crashlog_query(self, name, since=None, until=None,
+                       limit=None, cursor=None):
+        # since and until are unix timestamps in seconds
+        task = {
+            "name": name,
+            "since": since,
+            "until": until,
+            "limit": limit,
+            "cursor": cursor,
+        }
+        return self.enqueue("crashlog-query", task)
+
+    def crashlog_stream(self, name, timestamp):
+        task = {
+            "name": name,
+            "timestamp": timestamp,
+        }
+        return self.stream_enqueue("crashlog-stream", task)
+
+    def crashlog_top(self, resolution=None, window=None, limit=None):
+        # window is a number of minute or hour buckets
+        task = {
+            "resolution": resolution,
+            "window": window,
+            "limit": limit,
+        }
+        return self.enqueue("crashlog-top", task)
+
+    def crashlog_rate(self, name, resolution=None, window=None):
+        task = {
+            "name": name,
+            "resolution": resolution,
+            "window": window,
+        }
+        return self.enqueue("crashlog-rate", task)
+
     # auth
     def signup(self, name, password):
         task = {
@@ -217,6 +622,12 @@ class FlowCloud(object):
         else:
             raise PermissionDenied("Unable to remove user %s." % name)
 
+    def user_remove_status(self, name):
+        if name == self.user:
+            return self.enqueue("user-remove-status", name)
+        else:
+            raise PermissionDenied("Unable to read status of user %s." % name)
+
     # buildlogs
     def buildlog_list(self, username):
         return self.enqueue("user-buildlog-list", username)
@@ -224,6 +635,17 @@ class FlowCloud(object):
     def buildlog_read(self, bl_id):
         return self.enqueue("user-buildlog-read", bl_id)
 
+    def buildlog_stream(self, bl_id, offset=0, length=None, encoding=None):
+        # negative offset counts from the end of the log.
+        # encoding (e.g. gzip) is acceptable encoding of the data
+        task = {
+            "id": bl_id,
+            "offset": offset,
+            "length": length,
+            "encoding": encoding,
+        }
+        return self.stream_enqueue("user-buildlog-stream", task)
+
     # apps
     def app_list(self):
         return self.enqueue("user-app-list", self.user)
@@ -241,22 +663,25 @@ class FlowCloud(object):
         task['user'] = self.user
         return self.stream_enqueue("user-upload", task)
 
-    def app_start(self, appname, version, profile):
+    def app_start(self, appname, version, profile, **fanout):
         task = {
             "appname": appname,
             "version": version,
             "profile": profile,
         }
+        task.update(fanout)
         return self.stream_enqueue("app-start", task)
 
-    def app_stop(self, appname, version):
+    def app_stop(self, appname, version, **fanout):
         task = {
             "appname": appname,
             "version": version,
         }
+        task.update(fanout)
         return self.stream_enqueue("app-stop", task)
 
-    def app_deploy(self, appname, version, profile, runlist, weight=0):
+    def app_deploy(self, appname, version, profile, runlist, weight=0,
+                   **fanout):
         task = {
             "appname": appname,
             "version": version,
@@ -264,4 +689,5 @@ class FlowCloud(object):
             "runlist": runlist,
             "weight": weight,
         }
+        task.update(fanout)
         return self.stream_enqueue("app-deploy", task)
@@ -19,13 +19,38 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-import json
+import time
+from functools import partial
 
 from tornado import web
+from tornado.ioloop import IOLoop
+
+from cocaine.flow.encoding import ResponseEncoder
+from cocaine.flow.executor import ExecutorOverloaded
+from cocaine.flow.executor import UNPACK
+from cocaine.flow.metrics import registry
+
+from cocaine.exceptions import ChokeEvent
+from cocaine.exceptions import ServiceError
 
 
 AuthHeaderName = "Authorization"
 
+# streamed chunks are sent once this much piled up or the interval passed
+DEFAULT_FLUSH_SIZE = 16 * 1024
+DEFAULT_FLUSH_INTERVAL = 0.1  # seconds
+
+EVENT_STREAM = "text/event-stream"
+# error code of flow-tools for a missing item
+ITEM_IS_ABSENT = -100
+
+
+class Overloaded(web.HTTPError):
+    """503 with Retry-After for the full queue of an executor pool"""
+    def __init__(self, retry_after, log_message=None):
+        super(Overloaded, self).__init__(503, log_message)
+        self.retry_after = retry_after
+
 
 class CocaineHanler(web.RequestHandler):
 
@@ -33,15 +58,52 @@ class CocaineHanler(web.RequestHandler):
         self.fw = self.application.guest()
 
     def send_json(self, data):
-        self.set_header("Content-Type", "application/json")
-        self.write(json.dumps(data))
+        # JSON or msgpack depending on Accept header
+        fmt, content_type, encode = ResponseEncoder.negotiate(
+            self.request.headers.get("Accept"))
+        self.set_header("Content-Type", content_type)
+        self.set_header("Vary", "Accept")
+        if self.request.method not in ("GET", "HEAD"):
+            self.write(encode(data))
+            return
+
+        # body and etag of cached resources are computed once
+        body, etag = self.fw.cache.serialized(data, fmt, encode)
+        self.set_header("Etag", etag)
+        if self.etag_matches(etag):
+            self.set_status(304)
+            return
+        self.write(body)
+
+    def etag_matches(self, etag):
+        inm = self.request.headers.get("If-None-Match")
+        if not inm:
+            return False
+        if inm.strip() == "*":
+            return True
+        tags = [tag.strip() for tag in inm.split(",")]
+        # weak comparison is enough for GET
+        return any(tag == etag or tag == "W/" + etag for tag in tags)
 
     def ok(self):
         self.send_json({})
 
-    def write_error(self, *args, **kwargs):
-        # hijack exception here
-        super(CocaineHanler, self).write_error(*args, **kwargs)
+    def on_finish(self):
+        route = self.__class__.__name__
+        registry.inc("flow_http_requests_total",
+                     (("route", route),
+                      ("method", self.request.method),
+                      ("code", self.get_status())))
+        registry.observe("flow_http_request_duration_seconds",
+                         self.request.request_time(),
+                         (("route", route),))
+
+    def write_error(self, status_code, **kwargs):
+        # headers are cleared before write_error
+        exc_info = kwargs.get("exc_info")
+        if exc_info is not None and isinstance(exc_info[1], Overloaded):
+            self.set_header("Retry-After", exc_info[1].retry_after)
+        super(CocaineHanler, self).write_error(status_code, **kwargs)
 
     @property
     def cipher(self):
@@ -51,9 +113,17 @@ class CocaineHanler(web.RequestHandler):
     def logger(self):
         return self.application.logger
 
-    @property
-    def run_background(self):
-        return self.application.run_background
+    def check_background(self, work_class=UNPACK):
+        try:
+            self.application.check_background(work_class)
+        except ExecutorOverloaded as err:
+            raise Overloaded(err.retry_after, str(err))
+
+    def run_background(self, func, callback, work_class=UNPACK):
+        try:
+            self.application.run_background(func, callback, work_class)
+        except ExecutorOverloaded as err:
+            raise Overloaded(err.retry_after, str(err))
 
 
 class AuthRequiredCocaineHandler(CocaineHanler):
@@ -76,3 +146,124 @@ class AuthRequiredCocaineHandler(CocaineHanler):
 
     def get_current_user(self):
         return self.user
+
+
+def on_chunk(self, r):
+    try:
+        item = r.get()
+        self.write_chunk(item)
+    except ChokeEvent:
+        self.logger.info("Close stream successfully")
+        self.finish()
+    except ServiceError as err:
+        self.logger.error(err)
+        status_code = 404 if err.code == ITEM_IS_ABSENT else 500
+        self.stream_error(status_code, self.stream_error_message)
+    except Exception as err:
+        self.logger.error(err)
+        self.stream_error(500, "Unknown error")
+
+
+class StreamingHandler(AuthRequiredCocaineHandler):
+    """Proxies a stream of flow-tools to the client.
+
+    Chunks are coalesced, so a chatty stream costs at most one write
+    per flush_interval unless flush_size bytes piled up. Clients
+    accepting text/event-stream get every flush as a Server-Sent Event.
+    """
+    streaming = False
+    stream_error_message = "Error occured while uploading"
+    # False for streams of raw data, which can't be sent as events
+    event_stream = True
+    flush_size = DEFAULT_FLUSH_SIZE
+    flush_interval = DEFAULT_FLUSH_INTERVAL
+
+    events = None
+    _pending = 0
+    _flush_timeout = None
+    _flushed = False
+
+    @classmethod
+    def configure_streaming(cls, flush_size=DEFAULT_FLUSH_SIZE,
+                            flush_interval=DEFAULT_FLUSH_INTERVAL):
+        cls.flush_size = flush_size
+        cls.flush_interval = flush_interval
+
+    def stream(self, fut):
+        # proxy chunks of flow-tools stream to the client
+        self.streaming = True
+        accepted = self.request.headers.get("Accept", "")
+        if self.event_stream and EVENT_STREAM in accepted:
+            self.events = list()
+            self.set_header("Content-Type", EVENT_STREAM)
+            self.set_header("Cache-Control", "no-cache")
+        registry.inc("flow_open_streams")
+        fut.then(partial(on_chunk, self))
+
+    def write_chunk(self, item):
+        if isinstance(item, dict):
+            self.write(item)
+            self.flush_chunks()
+            return
+
+        if self.events is not None:
+            self.events.append(item)
+        else:
+            self.write(item)
+        self._pending += len(item)
+        if self._pending >= self.flush_size:
+            self.flush_chunks()
+        elif self._flush_timeout is None:
+            self._flush_timeout = IOLoop.current().add_timeout(
+                time.time() + self.flush_interval, self.flush_chunks)
+
+    def flush_chunks(self):
+        self._cancel_flush()
+        self._write_events()
+        self._pending = 0
+        self._flushed = True
+        self.flush()
+
+    def stream_error(self, status_code, message):
+        # the status is sent with the first flush, later the error
+        # is only reported in the body
+        if not self._flushed:
+            self._cancel_flush()
+            self.events = None
+            self._pending = 0
+            self.clear()
+            self.set_status(status_code)
+        self.finish(message)
+
+    def _write_events(self):
+        if not self.events:
+            return
+        data = "".join(self.events)
+        self.events = list()
+        self.write("".join("data: %s\n" % line
+                           for line in data.splitlines()) + "\n")
+
+    def _cancel_flush(self):
+        if self._flush_timeout is not None:
+            IOLoop.current().remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+
+    def finish(self, chunk=None):
+        if self.events is not None:
+            # the last message is an event as well
+            if chunk is not None:
+                self.events.append(chunk)
+                chunk = None
+            self._write_events()
+        self._cancel_flush()
+        return super(StreamingHandler, self).finish(chunk)
+
+    def on_connection_close(self):
+        self._cancel_flush()
+        super(StreamingHandler, self).on_connection_close()
+
+    def on_finish(self):
+        if self.streaming:
+            self.streaming = False
+            registry.dec("flow_open_streams")
+        super(StreamingHandler, self).on_finish()
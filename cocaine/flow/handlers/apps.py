@@ -24,28 +24,16 @@ from functools import partial
 from tornado import gen
 from tornado import web
 
+from cocaine.flow.executor import CLEANUP
+from cocaine.flow.executor import ExecutorOverloaded
+from cocaine.flow.executor import UNPACK
 from cocaine.flow.handlers import AuthRequiredCocaineHandler
+from cocaine.flow.handlers import StreamingHandler
 from cocaine.flow.flowcloud import AppUploadInfo
 from cocaine.flow.temprepo import unpack_archive
+from cocaine.flow.temprepo import UploadSpool
 
-from cocaine.exceptions import ChokeEvent
-from cocaine.exceptions import ServiceError
-
-
-def on_chunk(self, r):
-    try:
-        item = r.get()
-        self.write(item)
-        self.flush()
-    except ChokeEvent:
-        self.logger.info("Close stream successfully")
-        self.finish()
-    except ServiceError as err:
-        self.logger.error(err)
-        self.finish("Error occured while uploading")
-    except Exception as err:
-        self.logger.error(err)
-        self.finish("Unknown error")
+DEFAULT_MAX_UPLOAD_SIZE = 1024 * 1024 * 1024  # 1GB
 
 
 class AppsList(AuthRequiredCocaineHandler):
@@ -55,7 +43,40 @@ class AppsList(AuthRequiredCocaineHandler):
         self.send_json(apps)
 
 
-class Apps(AuthRequiredCocaineHandler):
+@web.stream_request_body
+class Apps(StreamingHandler):
+    spool = None
+    tempdir = None
+
+    def prepare(self):
+        super(Apps, self).prepare()
+        if self.request.method == "POST":
+            # don't read an archive, which can't be unpacked now
+            self.check_background(UNPACK)
+            # archive is streamed into the spool chunk by chunk,
+            # so memory usage doesn't depend on the size of an upload
+            max_size = self.settings.get("max_upload_size",
+                                         DEFAULT_MAX_UPLOAD_SIZE)
+            self.request.connection.set_max_body_size(max_size)
+            self.spool = UploadSpool()
+
+    def data_received(self, chunk):
+        if self.spool is not None:
+            self.spool.write(chunk)
+
+    def on_finish(self):
+        super(Apps, self).on_finish()
+        if self.spool is not None:
+            self.spool.close()
+        # clean tempdir after the finish of request
+        if self.tempdir is not None:
+            try:
+                self.application.run_background(self.tempdir.clean,
+                                                lambda _: None,
+                                                work_class=CLEANUP)
+            except ExecutorOverloaded:
+                self.tempdir.clean()
+
     @gen.coroutine
     def get(self, app, version):
         info = yield self.fw.app_info(app, version)
@@ -64,49 +85,101 @@ class Apps(AuthRequiredCocaineHandler):
     @gen.coroutine
     @web.asynchronous
     def post(self, app, version):
+        self.logger.debug("Upload %s_%s: %d bytes received",
+                          app, version, self.spool.size)
         # unpack body in thread pool and return
         # instance of TempDir
         # todo: it might be better to unpack in flow-tools
         # for using remote cocaine-runtime
         self.tempdir = yield gen.Task(self.run_background,
                                       partial(unpack_archive,
-                                              self.request.body))
+                                              self.spool),
+                                      work_class=UNPACK)
+        self.spool.close()
         if self.tempdir is None:
             raise Exception("Unable to unpack body")
 
         upl_info = AppUploadInfo(app, version, self.tempdir.path)
-        # clean tempdir after the finish of request
-        self.on_finish = self.tempdir.clean
 
         # flow-tools cocaine future object
         fut = self.fw.app_upload(upl_info)
-        fut.then(partial(on_chunk, self))
-
-
-class AppStart(AuthRequiredCocaineHandler):
+        self.stream(fut)
+
+
+class AppFanoutHandler(StreamingHandler):
+    """Streams an operation on all hosts of the cloud"""
+    def fanout_options(self):
+        # number of hosts processed at once and per-host timeout
+        options = dict()
+        for name in ("parallel", "timeout"):
+            value = self.get_argument(name, None)
+            if value is None:
+                continue
+            try:
+                options[name] = int(value)
+            except ValueError:
+                raise web.HTTPError(400, "Invalid %s value %s" % (name,
+                                                                  value))
+            if options[name] <= 0:
+                raise web.HTTPError(400, "%s should be positive" % name)
+        return options
+
+
+class AppStart(AppFanoutHandler):
     @gen.coroutine
     @web.asynchronous
     def post(self, app, version):
         profile = self.get_argument("profile")
-        fut = self.fw.app_start(app, version, profile)
-        fut.then(partial(on_chunk, self))
+        fut = self.fw.app_start(app, version, profile,
+                                **self.fanout_options())
+        self.stream(fut)
 
 
-class AppStop(AuthRequiredCocaineHandler):
+class AppStop(AppFanoutHandler):
     @gen.coroutine
     @web.asynchronous
     def post(self, app, version):
-        fut = self.fw.app_stop(app, version)
-        fut.then(partial(on_chunk, self))
+        fut = self.fw.app_stop(app, version, **self.fanout_options())
+        self.stream(fut)
 
 
-class AppDeploy(AuthRequiredCocaineHandler):
+class AppDeploy(AppFanoutHandler):
     @gen.coroutine
     @web.asynchronous
     def post(self, app, version):
         profile = self.get_argument("profile")
         runlist = self.get_argument("runlist")
         weight = int(self.get_argument("weight", 0))
+        options = self.fanout_options()
+        options.update(self.rolling_options())
         fut = self.fw.app_deploy(app, version,
-                                 profile, runlist, weight)
-        fut.then(partial(on_chunk, self))
+                                 profile, runlist, weight,
+                                 **options)
+        self.stream(fut)
+
+    def rolling_options(self):
+        # batch and max_failed are either a number of hosts or a percentage
+        options = dict()
+        for name in ("batch", "max_failed"):
+            value = self.get_argument(name, None)
+            if value is None:
+                continue
+            try:
+                if value.endswith("%"):
+                    float(value[:-1])
+                    options[name] = value
+                else:
+                    options[name] = int(value)
+            except ValueError:
+                raise web.HTTPError(400, "Invalid %s value %s" % (name,
+                                                                  value))
+        pause = self.get_argument("pause", None)
+        if pause is not None:
+            try:
+                options["pause"] = float(pause)
+            except ValueError:
+                raise web.HTTPError(400, "Invalid pause value %s" % pause)
+            if not 0 <= options["pause"] < float("inf"):
+                raise web.HTTPError(400, "pause should be a non-negative "
+                                    "number")
+        return options
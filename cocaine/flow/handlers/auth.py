@@ -65,3 +65,9 @@ class RemoveUser(AuthRequiredCocaineHandler):
     def delete(self, name):
         yield self.fw.user_remove(name)
         self.ok()
+
+    @gen.coroutine
+    def get(self, name):
+        # progress of background removal of upload logs
+        status = yield self.fw.user_remove_status(name)
+        self.send_json(status)
@@ -0,0 +1,104 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import numbers
+
+from tornado import gen
+from tornado import web
+from tornado.util import basestring_type
+
+from cocaine.flow.flowcloud import BATCH_METHODS
+from cocaine.flow.handlers import AuthRequiredCocaineHandler
+
+MAX_BATCH_SIZE = 100
+# ids are used as keys, so they should be hashable scalars
+ID_TYPES = (numbers.Integral, basestring_type)
+
+
+def parse_operations(body):
+    try:
+        operations = json.loads(body)
+    except ValueError:
+        raise web.HTTPError(400, "Body should be a JSON list of operations")
+
+    if not isinstance(operations, list):
+        raise web.HTTPError(400, "Body should be a JSON list of operations")
+    if len(operations) > MAX_BATCH_SIZE:
+        raise web.HTTPError(400, "Too many operations. Max %d" % MAX_BATCH_SIZE)
+
+    seen = set()
+    for i, op in enumerate(operations):
+        if not isinstance(op, dict) or op.get("method") not in BATCH_METHODS:
+            raise web.HTTPError(400, "Operation %d has invalid method" % i)
+        op.setdefault("id", i)
+        op.setdefault("args", [])
+        op.setdefault("after", [])
+        if not isinstance(op["args"], list):
+            raise web.HTTPError(400, "Arguments of %d should be a list" % i)
+        if not isinstance(op["id"], ID_TYPES):
+            raise web.HTTPError(400, "Id of %d should be a string or a number" % i)
+        after = op["after"]
+        if not isinstance(after, list) or not all(isinstance(dep, ID_TYPES)
+                                                  for dep in after):
+            raise web.HTTPError(400, "After of %d should be a list of ids" % i)
+        # only previous operations could be awaited, so there're no cycles
+        if not all(dep in seen for dep in op["after"]):
+            raise web.HTTPError(400, "Operation %d depends on unknown one" % i)
+        if op["id"] in seen:
+            raise web.HTTPError(400, "Operation id %s is duplicated" % op["id"])
+        seen.add(op["id"])
+    return operations
+
+
+class Batch(AuthRequiredCocaineHandler):
+    @gen.coroutine
+    def post(self):
+        operations = parse_operations(self.request.body)
+        results = [None] * len(operations)
+        # id -> future which resolves with True if operation succeeded
+        done = dict()
+
+        @gen.coroutine
+        def execute(i, op):
+            result = {"id": op["id"]}
+            results[i] = result
+            if op["after"]:
+                succeeded = yield [done[dep] for dep in op["after"]]
+                if not all(succeeded):
+                    result["error"] = "Dependency failed"
+                    raise gen.Return(False)
+
+            try:
+                method = getattr(self.fw, op["method"])
+                result["result"] = yield method(*op["args"])
+            except Exception as err:
+                self.logger.error("Batch operation %s failed: %s",
+                                  op["method"], err)
+                result["error"] = str(err)
+                raise gen.Return(False)
+            raise gen.Return(True)
+
+        # independent operations run concurrently
+        for i, op in enumerate(operations):
+            done[op["id"]] = execute(i, op)
+        yield list(done.values())
+        self.send_json(results)
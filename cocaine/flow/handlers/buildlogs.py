@@ -19,16 +19,101 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import re
+
 from tornado import gen
+from tornado import web
 
 from cocaine.flow.handlers import AuthRequiredCocaineHandler
+from cocaine.flow.handlers import StreamingHandler
 
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
 
-class Buildlogs(AuthRequiredCocaineHandler):
-    @gen.coroutine
+
+def parse_range(header):
+    """Return (offset, length) of a single range of Range header.
+
+    None is returned if there is no header or it's unsupported.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first and last:
+        if int(last) < int(first):
+            return None
+        return int(first), int(last) - int(first) + 1
+    if first:
+        return int(first), None
+    if last:
+        # suffix range: the last N bytes, an empty one is unsatisfiable
+        suffix = int(last)
+        return (-suffix, None) if suffix else (0, 0)
+    return None
+
+
+class Buildlogs(StreamingHandler):
+    stream_error_message = "Unable to read buildlog"
+    event_stream = False
+    ranged = False
+
+    def query_range(self):
+        # negative offset counts from the end of the log
+        values = dict()
+        for name in ("offset", "length"):
+            value = self.get_argument(name, None)
+            if value is None:
+                continue
+            try:
+                values[name] = int(value)
+            except ValueError:
+                raise web.HTTPError(400, "Invalid %s value %s" % (name,
+                                                                  value))
+        if values.get("length", 0) < 0:
+            raise web.HTTPError(400, "length should be non-negative")
+        return values.get("offset", 0), values.get("length")
+
+    @web.asynchronous
     def get(self, name):
-        buildlog = yield self.fw.buildlog_read(name)
-        self.write(buildlog)
+        requested = parse_range(self.request.headers.get("Range"))
+        self.ranged = requested is not None
+        if requested is None:
+            requested = self.query_range()
+
+        # stored gzip is passed as is if the whole log is requested.
+        # Content-Range counts plain bytes, so ranges are never passed
+        encoding = None
+        accepted = self.request.headers.get("Accept-Encoding", "")
+        whole = requested == (0, None) and not self.ranged
+        if whole and "gzip" in accepted:
+            encoding = "gzip"
+
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.set_header("Accept-Ranges", "bytes")
+        self.set_header("Vary", "Accept-Encoding")
+        self.stream(self.fw.buildlog_stream(name, *requested,
+                                            encoding=encoding))
+
+    def write_chunk(self, item):
+        if not isinstance(item, dict):
+            super(Buildlogs, self).write_chunk(item)
+            return
+
+        # the first chunk describes the requested part of the log
+        size, offset, length = item["size"], item["offset"], item["length"]
+        if self.ranged:
+            if length == 0:
+                self.set_status(416)
+                self.set_header("Content-Range", "bytes */%d" % size)
+                return
+            self.set_status(206)
+            self.set_header("Content-Range", "bytes %d-%d/%d" % (
+                offset, offset + length - 1, size))
+        if item.get("encoding") is not None:
+            # size of the compressed body is unknown
+            self.set_header("Content-Encoding", item["encoding"])
+        else:
+            self.set_header("Content-Length", length)
 
 
 class BuildlogsList(AuthRequiredCocaineHandler):
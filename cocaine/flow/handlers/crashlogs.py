@@ -20,19 +20,96 @@
 #
 
 from tornado import gen
+from tornado import web
 
 from cocaine.flow.handlers import AuthRequiredCocaineHandler
+from cocaine.flow.handlers import StreamingHandler
+
+MAX_PAGE_LIMIT = 1000
+MAX_TOP = 1000
+RESOLUTIONS = ("minute", "hour")
 
 
 class CrashlogsList(AuthRequiredCocaineHandler):
+    def query_options(self):
+        options = dict()
+        for name, convert in (("since", float), ("until", float),
+                              ("limit", int)):
+            value = self.get_argument(name, None)
+            if value is None:
+                continue
+            try:
+                options[name] = convert(value)
+            except ValueError:
+                raise web.HTTPError(400, "Invalid %s value %s" % (name,
+                                                                  value))
+        if not 0 < options.get("limit", 1) <= MAX_PAGE_LIMIT:
+            raise web.HTTPError(400, "limit should be in 1..%d"
+                                % MAX_PAGE_LIMIT)
+        cursor = self.get_argument("cursor", None)
+        if cursor is not None:
+            options["cursor"] = cursor
+        return options
+
     @gen.coroutine
     def get(self, name):
-        crashlogs = yield self.fw.crashlog_list(name)
-        self.send_json(crashlogs)
+        options = self.query_options()
+        if options:
+            page = yield self.fw.crashlog_query(name, **options)
+            self.send_json(page)
+        else:
+            # all crashlogs as a plain list of keys
+            crashlogs = yield self.fw.crashlog_list(name)
+            self.send_json(crashlogs)
+
 
+class CrashStatsHandler(AuthRequiredCocaineHandler):
+    def stats_options(self):
+        options = dict()
+        resolution = self.get_argument("resolution", None)
+        if resolution is not None:
+            if resolution not in RESOLUTIONS:
+                raise web.HTTPError(400, "resolution should be one of %s"
+                                    % ", ".join(RESOLUTIONS))
+            options["resolution"] = resolution
+        for name in ("window", "top"):
+            value = self.get_argument(name, None)
+            if value is None:
+                continue
+            try:
+                options[name] = int(value)
+            except ValueError:
+                raise web.HTTPError(400, "Invalid %s value %s" % (name,
+                                                                  value))
+        if not 0 < options.get("top", 1) <= MAX_TOP:
+            raise web.HTTPError(400, "top should be in 1..%d" % MAX_TOP)
+        return options
 
-class Crashlogs(AuthRequiredCocaineHandler):
+
+class CrashStatsTop(CrashStatsHandler):
     @gen.coroutine
+    def get(self):
+        options = self.stats_options()
+        top = yield self.fw.crashlog_top(options.get("resolution"),
+                                         options.get("window"),
+                                         options.get("top"))
+        self.send_json(top)
+
+
+class CrashStats(CrashStatsHandler):
+    @gen.coroutine
+    def get(self, name):
+        options = self.stats_options()
+        rate = yield self.fw.crashlog_rate(name, options.get("resolution"),
+                                           options.get("window"))
+        self.send_json(rate)
+
+
+class Crashlogs(StreamingHandler):
+    stream_error_message = "Unable to read crashlog"
+    event_stream = False
+
+    @web.asynchronous
     def get(self, name, timestamp):
-        crashlog = yield self.fw.crashlog_view(name, timestamp)
-        self.write('\n'.join(crashlog))
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.stream(self.fw.crashlog_stream(name, timestamp))
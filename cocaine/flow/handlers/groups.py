@@ -68,5 +68,9 @@ class RoutingGroupsPushPop(AuthRequiredCocaineHandler):
 class RoutingGroupsRefresh(AuthRequiredCocaineHandler):
     @gen.coroutine
     def post(self, name):
-        yield self.fw.group_refresh(name)
-        self.ok()
+        # several groups could be passed as ?group=a&group=b
+        names = self.get_arguments("group")
+        if name or not names:
+            names.insert(0, name)
+        status = yield self.fw.group_refresh(names)
+        self.send_json(status or {})
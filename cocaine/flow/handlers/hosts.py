@@ -43,5 +43,8 @@ class Hosts(AuthRequiredCocaineHandler):
 class HostsList(AuthRequiredCocaineHandler):
     @gen.coroutine
     def get(self):
-        hosts = yield self.fw.host_list()
+        if self.get_argument("health", None):
+            hosts = yield self.fw.host_health()
+        else:
+            hosts = yield self.fw.host_list()
         self.send_json(hosts)
@@ -26,6 +26,9 @@ from tornado import web
 from tornado import gen
 from tornado.ioloop import IOLoop
 
+from cocaine.flow.flowcloud import FlowCloud
+from cocaine.flow.flowcloud import FlowTools
+from cocaine.flow.metrics import registry
 from cocaine.tools.helpers._unix import AsyncUnixHTTPClient
 from tornado.httpclient import AsyncHTTPClient
 
@@ -35,6 +38,12 @@ class Ping(web.RequestHandler):
         self.write("Pong")
 
 
+class Metrics(web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(registry.render())
+
+
 class Status(web.RequestHandler):
     @gen.coroutine
     def get(self):
@@ -75,4 +84,9 @@ class Status(web.RequestHandler):
             pass
 
         self.write({"Docker": docker_res,
-                    "Registry": registry_res})
+                    "Registry": registry_res,
+                    "Executor": self.application.executor.stats(),
+                    "Cache": FlowCloud.cache.stats(),
+                    "Coalescing": FlowCloud.inflight_stats(),
+                    "FlowTools": FlowTools.instance().stats(),
+                    "Tokens": self.application.cipher.cache_stats()})
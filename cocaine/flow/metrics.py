@@ -0,0 +1,160 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+from collections import OrderedDict
+
+
+# upper bounds of histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+    """Fixed-bucket histogram of observed values.
+
+    It isn't thread-safe: observe it from the IOLoop thread only.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # the last counter is +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        result = list()
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def dump(self):
+        return {
+            "buckets": [("+Inf" if bound == float("inf") else bound, total)
+                        for bound, total in self.cumulative()],
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    """Metrics of the process in Prometheus text format.
+
+    Labels are passed as a tuple of (name, value) pairs.
+    Collectors are called on render() and return {labels: value}.
+    """
+    def __init__(self):
+        # name -> (type, help)
+        self._families = OrderedDict()
+        self._values = dict()
+        self._collectors = dict()
+
+    def _register(self, name, kind, help, collector=None):
+        if name not in self._families:
+            self._families[name] = (kind, help)
+            self._values[name] = dict()
+        if collector is not None:
+            self._collectors[name] = collector
+
+    def counter(self, name, help, collector=None):
+        self._register(name, "counter", help, collector)
+
+    def gauge(self, name, help, collector=None):
+        self._register(name, "gauge", help, collector)
+
+    def histogram(self, name, help):
+        self._register(name, "histogram", help)
+
+    def inc(self, name, labels=(), value=1):
+        values = self._values[name]
+        values[labels] = values.get(labels, 0) + value
+
+    def dec(self, name, labels=(), value=1):
+        self.inc(name, labels, -value)
+
+    def observe(self, name, value, labels=()):
+        values = self._values[name]
+        hist = values.get(labels)
+        if hist is None:
+            hist = values[labels] = Histogram()
+        hist.observe(value)
+
+    def render(self):
+        lines = list()
+        for name, (kind, help) in self._families.items():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            values = self._values[name]
+            if name in self._collectors:
+                values = dict(values)
+                values.update(self._collectors[name]())
+
+            for labels, value in sorted(values.items()):
+                if kind != "histogram":
+                    lines.append("%s%s %s" % (name, _format_labels(labels),
+                                              _format_value(value)))
+                    continue
+
+                for bound, total in value.cumulative():
+                    bucket_labels = labels + (("le", _format_value(bound)),)
+                    lines.append("%s_bucket%s %d" % (name,
+                                                     _format_labels(bucket_labels),
+                                                     total))
+                lines.append("%s_sum%s %s" % (name, _format_labels(labels),
+                                              _format_value(value.sum)))
+                lines.append("%s_count%s %d" % (name, _format_labels(labels),
+                                                value.count))
+        lines.append("")
+        return "\n".join(lines)
+
+
+registry = Registry()
+
+registry.counter("flow_http_requests_total",
+                 "HTTP requests by route, method and status code")
+registry.histogram("flow_http_request_duration_seconds",
+                   "HTTP request latency by route")
+registry.counter("flow_tools_calls_total",
+                 "flow-tools calls by method and result")
+registry.histogram("flow_tools_call_duration_seconds",
+                   "flow-tools call latency by method")
+registry.gauge("flow_open_streams",
+               "streaming responses in progress")
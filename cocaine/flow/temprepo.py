@@ -32,6 +32,9 @@ except ImportError:
 
 logger = logging.getLogger()
 
+# uploaded body is kept in memory up to this size, then spilled to disk
+UPLOAD_SPOOL_SIZE = 1024 * 1024
+
 
 class TempDir(object):
     def __init__(self):
@@ -44,8 +47,27 @@ class TempDir(object):
         shutil.rmtree(self.path, ignore_errors=True)
 
 
+class UploadSpool(object):
+    """Collects streamed request body chunks into a temporary file"""
+    def __init__(self, max_size=UPLOAD_SPOOL_SIZE):
+        self.fileobj = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.size = 0
+
+    def write(self, chunk):
+        self.fileobj.write(chunk)
+        self.size += len(chunk)
+
+    def close(self):
+        self.fileobj.close()
+
+
 def unpack_archive(data):
-    fileobj = BytesIO(data)
+    # data is either the raw archive or a file-like object (e.g. UploadSpool)
+    if hasattr(data, "fileobj"):
+        fileobj = data.fileobj
+        fileobj.seek(0)
+    else:
+        fileobj = BytesIO(data)
     try:
         archive = tarfile.open(fileobj=fileobj)
         # NOTE: this dir could be read only by the same UID
@@ -20,19 +20,46 @@
 #
 
 import json
+import time
+from collections import OrderedDict
 
 from tornado import web
 
 
 TOKEN_LIFETIME = 1  # days
+TOKEN_CACHE_SIZE = 10000
+
+
+def token_timestamp(token):
+    """Extract the creation time of the already verified token"""
+    if token.startswith("2|"):
+        # 2|len:key_version|len:timestamp|len:name|len:value|signature
+        rest = token[2:]
+        fields = list()
+        for _ in range(2):
+            length, _, rest = rest.partition(":")
+            n = int(length)
+            fields.append(rest[:n])
+            rest = rest[n + 1:]
+        return int(fields[1])
+    # value|timestamp|signature
+    return int(token.split("|")[1])
 
 
 class Token(object):
     value_name = "TOKEN"
 
-    def __init__(self, key, lifetime=TOKEN_LIFETIME):
+    def __init__(self, key, lifetime=TOKEN_LIFETIME,
+                 cache_size=TOKEN_CACHE_SIZE):
         self.key = key
         self.lifetime = lifetime
+        # LRU of verified tokens: token -> (expiration time, user_info)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
     def pack_user(self, user_info):
         assert "password" not in user_info
@@ -40,11 +67,38 @@ class Token(object):
         return web.create_signed_value(self.key, self.value_name, value)
 
     def valid(self, token):
+        item = self._cache.pop(token, None)
+        if item is not None:
+            expires, user_info = item
+            if expires > time.time():
+                self._cache[token] = item
+                self.hits += 1
+                return dict(user_info)
+            self.expirations += 1
+        self.misses += 1
+
         raw = web.decode_signed_value(self.key, self.value_name, token, self.lifetime)
         if raw is None:
             raise ValueError("Invalid token")
-        else:
-            return json.loads(raw)
+
+        user_info = json.loads(raw)
+        if self.cache_size > 0:
+            expires = token_timestamp(token) + self.lifetime * 86400
+            self._cache[token] = (expires, dict(user_info))
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+        return user_info
+
+    def cache_stats(self):
+        return {
+            "size": self.cache_size,
+            "items": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
 
 
 if __name__ == "__main__":
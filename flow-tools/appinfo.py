@@ -0,0 +1,86 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+from cocaine.asio.engine import asynchronous
+from cocaine.logging import Logger
+
+from fanout import bounded_map
+
+log = Logger()
+
+DEFAULT_INFO_PARALLEL = 50
+DEFAULT_INFO_TIMEOUT = 5  # seconds
+DEFAULT_INFO_TTL = 5  # seconds
+
+
+class AppInfoCollector(object):
+    """Collects info of an app from every host concurrently.
+
+    Successful per-host answers are cached for `ttl` seconds.
+    Hosts which failed or haven't answered within `timeout`
+    are reported as {"error": <reason>}.
+    """
+    def __init__(self, nodepool, parallel=DEFAULT_INFO_PARALLEL,
+                 timeout=DEFAULT_INFO_TIMEOUT, ttl=DEFAULT_INFO_TTL):
+        self.nodepool = nodepool
+        self.parallel = parallel
+        self.timeout = timeout
+        self.ttl = ttl
+        # (host, appname) -> (expires, info)
+        self._cache = dict()
+
+    @asynchronous
+    def collect(self, appname, hosts):
+        now = time.time()
+        info = dict()
+        missing = list()
+        for host in hosts:
+            cached = self._cache.get((host, appname))
+            if cached is not None and cached[0] > now:
+                info[host] = cached[1]
+            else:
+                missing.append(host)
+
+        results = yield bounded_map(lambda host: self._info(host, appname),
+                                    missing, self.parallel, self.timeout)
+        expires = time.time() + self.ttl
+        for host, res in zip(missing, results):
+            if isinstance(res, Exception):
+                log.error("Unable to get info of app %s from host %s: %s"
+                          % (appname, host, res))
+                info[host] = {"error": str(res) or res.__class__.__name__}
+            else:
+                self._cache[(host, appname)] = (expires, res)
+                info[host] = res
+        self._expire()
+        yield info
+
+    def _info(self, host, appname):
+        return self.nodepool.call(host, appname, self.timeout,
+                                  lambda appinstance: appinstance.info())
+
+    def _expire(self):
+        now = time.time()
+        for key, (expires, _) in list(self._cache.items()):
+            if expires <= now:
+                del self._cache[key]
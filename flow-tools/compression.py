@@ -0,0 +1,107 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import zlib
+
+# compressed records start with MAGIC, the codec name and ":".
+# Records written before compression have no header and are
+# returned as is.
+MAGIC = "\x00flowz:"
+
+GZIP = "gzip"
+ZLIB = "zlib"
+
+# codec of records written by flow per namespace, None keeps them raw
+NAMESPACE_CODECS = {
+    "flow-users@logs": GZIP,
+}
+
+# zlib wbits of the codecs
+WBITS = {
+    GZIP: 16 + zlib.MAX_WBITS,
+    ZLIB: zlib.MAX_WBITS,
+}
+# zlib writes gzip header without optional fields
+GZIP_HEADER_SIZE = 10
+COMPRESS_LEVEL = 6
+
+
+def codec_for(namespace):
+    return NAMESPACE_CODECS.get(namespace)
+
+
+def split_header(record):
+    """Return (codec, payload). Codec is None for raw records"""
+    if not isinstance(record, str) or not record.startswith(MAGIC):
+        return None, record
+    codec, _, payload = record[len(MAGIC):].partition(":")
+    if codec not in WBITS:
+        raise ValueError("Unknown compression codec %s" % codec)
+    return codec, payload
+
+
+def add_header(codec, payload):
+    return "%s%s:%s" % (MAGIC, codec, payload)
+
+
+def pack(data, codec):
+    if codec is None:
+        return data
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, WBITS[codec])
+    return add_header(codec, compressor.compress(data) + compressor.flush())
+
+
+def unpack(record):
+    codec, payload = split_header(record)
+    if codec is None:
+        return payload
+    return zlib.decompress(payload, WBITS[codec])
+
+
+class SegmentCompressor(object):
+    """Compresses consecutive segments of one stream.
+
+    Every segment ends with a full flush, so it could be decompressed
+    on its own by unpack_segment(). Payloads of all segments put
+    together make a single valid stream, e.g. gzip body for HTTP.
+    """
+    def __init__(self, codec):
+        self.codec = codec
+        self._compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                            WBITS[codec])
+
+    def segment(self, data, last=False):
+        mode = zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH
+        payload = self._compressor.compress(data) + self._compressor.flush(mode)
+        return add_header(self.codec, payload)
+
+
+def unpack_segment(record, n):
+    """Decompress n-th segment written by SegmentCompressor"""
+    codec, payload = split_header(record)
+    if codec is None:
+        return payload
+    if n == 0:
+        # skip the stream header
+        payload = payload[GZIP_HEADER_SIZE if codec == GZIP else 2:]
+    # raw deflate, the trailer of the last segment is ignored
+    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(payload)
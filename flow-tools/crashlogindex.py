@@ -0,0 +1,204 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import bisect
+import time
+
+from tornado.ioloop import PeriodicCallback
+
+from cocaine.asio.engine import asynchronous
+from cocaine.futures import Deferred
+from cocaine.logging import Logger
+
+from fanout import trigger_later
+
+logger = Logger()
+
+CRASHLOGS_NAMESPACE = "crashlogs"
+
+# keys are listed from the storage again after that
+DEFAULT_REFRESH_INTERVAL = 10  # seconds
+# older list isn't returned, the query waits for the reload
+DEFAULT_MAX_STALE = 30  # seconds
+# index of an app isn't kept after that
+DEFAULT_IDLE_TIMEOUT = 600  # seconds
+DEFAULT_CHECK_INTERVAL = 60  # seconds
+DEFAULT_PAGE_LIMIT = 100
+
+# crashlog keys are "<timestamp in microseconds>:<uuid>"
+KEY_SEPARATOR = ":"
+MICROSECONDS = 1000000
+
+
+def parse_key(key):
+    """Return (timestamp, key) or None if the key isn't a crashlog"""
+    timestamp, sep, _ = key.partition(KEY_SEPARATOR)
+    if not sep:
+        return None
+    try:
+        return int(timestamp), key
+    except ValueError:
+        return None
+
+
+def to_timestamp(seconds):
+    return int(float(seconds) * MICROSECONDS)
+
+
+class AppCrashlogs(object):
+    def __init__(self):
+        # sorted list of (timestamp, key), None until the first load
+        self.entries = None
+        self.loaded_at = 0
+        self.last_used = 0
+        self.loading = False
+        self.waiters = list()
+
+
+class CrashlogIndex(object):
+    """Crashlogs of apps sorted by timestamp.
+
+    Crashlogs are written by cocaine-runtime, so keys of an app are
+    listed from the storage at most once per refresh_interval and
+    all queries are served from memory. A stale index is returned
+    at once and reloaded in background, unless it's older than
+    max_stale, e.g. after the app has been idle for a while.
+
+    on_load(name, previous, entries) is called after every load,
+    previous is None if the app hasn't been loaded before.
+    """
+    def __init__(self, storage, refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                 max_stale=DEFAULT_MAX_STALE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.storage = storage
+        self.refresh_interval = refresh_interval
+        self.max_stale = max(max_stale, refresh_interval)
+        self.idle_timeout = idle_timeout
+        self.on_load = None
+        # appname -> AppCrashlogs
+        self._apps = dict()
+        self._checker = PeriodicCallback(self.check, check_interval * 1000)
+        self._checker.start()
+
+    def entries(self, name, fresh=False, touch=True):
+        """Return Deferred triggered with sorted (timestamp, key) of an app.
+
+        fresh waits for a reload instead of returning the current list.
+        Without touch the call doesn't keep the app from idle eviction.
+        """
+        deferred = Deferred()
+        app = self._apps.get(name)
+        if app is None:
+            app = self._apps[name] = AppCrashlogs()
+        if touch:
+            app.last_used = time.time()
+
+        age = time.time() - app.loaded_at
+        cached = app.entries is not None and age <= self.max_stale
+        if cached and not fresh:
+            trigger_later(deferred, app.entries)
+        else:
+            app.waiters.append(deferred)
+
+        stale = age > self.refresh_interval
+        if not app.loading and (not cached or stale or fresh):
+            app.loading = True
+            self._load(name, app)
+        return deferred
+
+    @asynchronous
+    def _load(self, name, app):
+        try:
+            keys = yield self.storage.find(CRASHLOGS_NAMESPACE, [name])
+        except Exception as err:
+            logger.error("Unable to list crashlogs of %s: %s" % (name, err))
+            app.loading = False
+            waiters, app.waiters = app.waiters, list()
+            for deferred in waiters:
+                deferred.error(err)
+            return
+
+        # the list is replaced, not changed, so given lists stay valid
+        previous = app.entries
+        app.entries = sorted(filter(None, map(parse_key, keys)))
+        app.loaded_at = time.time()
+        app.loading = False
+        if self.on_load is not None:
+            try:
+                self.on_load(name, previous, app.entries)
+            except Exception as err:
+                logger.error("Unable to handle crashlogs of %s: %s"
+                             % (name, err))
+        waiters, app.waiters = app.waiters, list()
+        for deferred in waiters:
+            deferred.trigger(app.entries)
+
+    @asynchronous
+    def query(self, name, since=None, until=None,
+              limit=DEFAULT_PAGE_LIMIT, cursor=None):
+        """Return a page of crashlog keys, the newest first.
+
+        since (inclusive) and until (exclusive) are unix timestamps in
+        seconds. cursor is "next" of the previous page, it's None
+        on the last one.
+        """
+        entries = yield self.entries(name)
+        lo = 0
+        if since is not None:
+            lo = bisect.bisect_left(entries, (to_timestamp(since),))
+        hi = len(entries)
+        if until is not None:
+            hi = bisect.bisect_left(entries, (to_timestamp(until),))
+        if cursor is not None:
+            position = parse_key(cursor)
+            if position is None:
+                raise ValueError("Invalid cursor %s" % cursor)
+            hi = min(hi, bisect.bisect_left(entries, position))
+
+        start = max(lo, hi - limit)
+        page = [key for _, key in reversed(entries[start:hi])]
+        yield {
+            "crashlogs": page,
+            "next": page[-1] if page and start > lo else None,
+        }
+
+    @asynchronous
+    def find(self, name, timestamp):
+        """Return keys of crashlogs with a given timestamp"""
+        timestamp = int(timestamp)
+        keys = None
+        for fresh in (False, True):
+            # it could be written after the last reload
+            entries = yield self.entries(name, fresh)
+            lo = bisect.bisect_left(entries, (timestamp,))
+            hi = bisect.bisect_left(entries, (timestamp + 1,))
+            keys = [key for _, key in entries[lo:hi]]
+            if keys:
+                break
+        yield keys
+
+    def check(self):
+        now = time.time()
+        for name, app in list(self._apps.items()):
+            if not app.loading and now - app.last_used > self.idle_timeout:
+                del self._apps[name]
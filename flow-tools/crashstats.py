@@ -0,0 +1,211 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import time
+from functools import partial
+
+from cocaine.asio.engine import asynchronous
+from cocaine.logging import Logger
+from cocaine.tools.actions import app
+
+from crashlogindex import MICROSECONDS
+from fanout import bounded_map
+from fanout import PeriodicRound
+
+log = Logger()
+
+DEFAULT_REFRESH_INTERVAL = 60  # seconds
+# apps without crashes in the history are checked that often
+DEFAULT_SWEEP_INTERVAL = 900  # seconds
+DEFAULT_REFRESH_PARALLEL = 10
+DEFAULT_TOP = 10
+
+MINUTE = "minute"
+HOUR = "hour"
+# resolution -> (bucket size in seconds, number of buckets kept)
+RESOLUTIONS = {
+    MINUTE: (60, 60),
+    HOUR: (3600, 7 * 24),
+}
+HISTORY = max(size * kept for size, kept in RESOLUTIONS.values())
+
+
+def check_window(resolution, window):
+    """Return the number of buckets, the whole history by default"""
+    if resolution not in RESOLUTIONS:
+        raise ValueError("Unknown resolution %s" % resolution)
+    kept = RESOLUTIONS[resolution][1]
+    if window is None:
+        return kept
+    if not 0 < window <= kept:
+        raise ValueError("window should be in 1..%d for %s" % (kept,
+                                                               resolution))
+    return window
+
+
+class AppCrashStats(object):
+    """Crash counters of an app by time buckets of every resolution"""
+    def __init__(self):
+        # resolution -> {bucket start: crashes}
+        self.buckets = dict((resolution, dict())
+                            for resolution in RESOLUTIONS)
+        # crashlog key -> timestamp of crashes in the history,
+        # so a crash is counted once however often it's listed
+        self.seen = dict()
+
+    def crash(self, key, timestamp, now):
+        if key in self.seen or timestamp <= now - HISTORY:
+            return
+        self.seen[key] = timestamp
+        self.add(timestamp, now)
+
+    def add(self, timestamp, now):
+        for resolution, (size, kept) in RESOLUTIONS.items():
+            start = int(timestamp // size * size)
+            if start <= now - size * kept:
+                # out of the history
+                continue
+            buckets = self.buckets[resolution]
+            buckets[start] = buckets.get(start, 0) + 1
+
+    def expire(self, now):
+        for resolution, (size, kept) in RESOLUTIONS.items():
+            buckets = self.buckets[resolution]
+            for start in list(buckets):
+                if start <= now - size * kept:
+                    del buckets[start]
+        for key, timestamp in list(self.seen.items()):
+            if timestamp <= now - HISTORY:
+                del self.seen[key]
+
+    def empty(self):
+        return not any(self.buckets.values())
+
+    def series(self, resolution, window, now):
+        """Return [[bucket start, crashes]] of the last window buckets"""
+        size = RESOLUTIONS[resolution][0]
+        last = int(now // size * size)
+        buckets = self.buckets[resolution]
+        return [[start, buckets.get(start, 0)]
+                for start in range(last - (window - 1) * size,
+                                   last + size, size)]
+
+    def count(self, resolution, window, now):
+        size = RESOLUTIONS[resolution][0]
+        since = int(now // size * size) - (window - 1) * size
+        return sum(count for start, count
+                   in self.buckets[resolution].items() if start >= since)
+
+
+class CrashStats(object):
+    """Crash counters of apps updated from the crashlog index.
+
+    Counters are increased by crashlogs which haven't been seen in
+    loads of the index before, so queries never touch the storage and
+    a crash stays counted after its crashlog is removed. Apps with
+    crashes in the history are reloaded through the index every
+    `interval` seconds. Others are checked by a sweep over all apps
+    every `sweep_interval` seconds, which leaves them to idle eviction
+    of the index. So an app which starts crashing is counted with up
+    to `sweep_interval` delay, unless its crashlogs are listed.
+    """
+    def __init__(self, storage, index,
+                 interval=DEFAULT_REFRESH_INTERVAL,
+                 sweep_interval=DEFAULT_SWEEP_INTERVAL,
+                 parallel=DEFAULT_REFRESH_PARALLEL):
+        self.storage = storage
+        self.index = index
+        self.parallel = parallel
+        # appname -> AppCrashStats
+        self._stats = dict()
+        index.on_load = self.update
+        self._refresher = PeriodicRound(self.refresh, interval)
+        self._refresher.start()
+        self._sweeper = PeriodicRound(self.sweep, sweep_interval)
+        self._sweeper.start(now=True)
+
+    def update(self, name, previous, entries):
+        # previous is ignored: the index may be reloaded from scratch
+        # after eviction, so seen crashlogs are tracked by the stats
+        now = time.time()
+        stats = self._stats.setdefault(name, AppCrashStats())
+        for timestamp, key in entries:
+            stats.crash(key, float(timestamp) / MICROSECONDS, now)
+        stats.expire(now)
+        if stats.empty():
+            del self._stats[name]
+
+    @asynchronous
+    def refresh(self):
+        try:
+            yield self._reload_all(list(self._stats), touch=True)
+        except Exception as err:
+            log.error("Unable to refresh crash stats: %s" % err)
+
+    @asynchronous
+    def sweep(self):
+        try:
+            apps = yield app.List(self.storage).execute()
+            for name in list(self._stats):
+                if name not in apps:
+                    del self._stats[name]
+
+            yield self._reload_all(apps, touch=False)
+        except Exception as err:
+            log.error("Unable to sweep crash stats: %s" % err)
+
+    @asynchronous
+    def _reload_all(self, names, touch):
+        results = yield bounded_map(partial(self._reload, touch=touch),
+                                    names, self.parallel)
+        for name, res in zip(names, results):
+            if isinstance(res, Exception):
+                log.error("Unable to list crashlogs of %s: %s" % (name, res))
+
+    @asynchronous
+    def _reload(self, name, touch):
+        # counters are updated by on_load of the index
+        entries = yield self.index.entries(name, touch=touch)
+        yield len(entries)
+
+    def top(self, resolution=MINUTE, window=None, limit=DEFAULT_TOP):
+        """Return [{"app", "crashes"}] of the most crashing apps"""
+        window = check_window(resolution, window)
+        now = time.time()
+        counts = list()
+        for name, stats in self._stats.items():
+            crashes = stats.count(resolution, window, now)
+            if crashes > 0:
+                counts.append((crashes, name))
+        counts.sort(key=lambda item: (-item[0], item[1]))
+        return [{"app": app_name, "crashes": count}
+                for count, app_name in counts[:limit]]
+
+    def rate(self, name, resolution=MINUTE, window=None):
+        """Return crashes of an app by buckets, the oldest first"""
+        window = check_window(resolution, window)
+        stats = self._stats.get(name, AppCrashStats())
+        return {
+            "resolution": resolution,
+            "bucket": RESOLUTIONS[resolution][0],
+            "series": stats.series(resolution, window, time.time()),
+        }
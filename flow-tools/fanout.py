@@ -0,0 +1,161 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+from functools import partial
+
+from tornado.ioloop import IOLoop
+from tornado.ioloop import PeriodicCallback
+
+from cocaine.asio.exceptions import TimeoutError
+from cocaine.futures import Deferred
+from cocaine.futures.chain import FutureResult
+
+
+def bounded_map(func, items, limit, timeout=None):
+    """Call func(item) for every item, at most `limit` at once.
+
+    func should return an yieldable chain (e.g. be `asynchronous`).
+    Returned Deferred is triggered with the list of results in the
+    order of items. Failed items have the exception as a result,
+    items which are out of `timeout` seconds have TimeoutError.
+    A timed out call keeps its slot until it's over, but no longer
+    than one more `timeout`.
+    """
+    io_loop = IOLoop.current()
+    deferred = Deferred()
+    items = list(items)
+    results = [None] * len(items)
+    done = [False] * len(items)
+    # call of the item is running and takes a slot
+    running = [False] * len(items)
+    state = {"next": 0, "running": 0, "done": 0}
+
+    def launch():
+        while state["running"] < limit and state["next"] < len(items):
+            i = state["next"]
+            state["next"] += 1
+            state["running"] += 1
+            running[i] = True
+            timer = None
+            if timeout is not None:
+                timer = io_loop.add_timeout(time.time() + timeout,
+                                            partial(on_timeout, i))
+            try:
+                func(items[i]).then(partial(on_done, i, timer))
+            except Exception as err:
+                io_loop.add_callback(partial(on_done, i, timer,
+                                             FutureResult(err)))
+
+    def on_timeout(i):
+        finish(i, TimeoutError(timeout))
+        # slow hosts mustn't make more than `limit` calls at once
+        io_loop.add_timeout(time.time() + timeout, partial(release, i))
+
+    def on_done(i, timer, result):
+        if timer is not None:
+            io_loop.remove_timeout(timer)
+        try:
+            value = result.get()
+        except Exception as err:
+            value = err
+        # late result of timed out item is dropped
+        finish(i, value)
+        release(i)
+
+    def finish(i, value):
+        if done[i]:
+            return
+        done[i] = True
+        results[i] = value
+        state["done"] += 1
+        if state["done"] == len(items):
+            deferred.trigger(results)
+
+    def release(i):
+        if not running[i]:
+            return
+        running[i] = False
+        state["running"] -= 1
+        launch()
+
+    if items:
+        launch()
+    else:
+        trigger_later(deferred, results)
+    return deferred
+
+
+def trigger_later(deferred, value=None):
+    """Trigger deferred with value on the next iteration of the loop.
+
+    NOTE: engine can't resume on a Deferred triggered before it's
+    yielded, so a result known at once must be delivered this way.
+    """
+    IOLoop.current().add_callback(partial(deferred.trigger, value))
+
+
+def error_later(deferred, err):
+    """Same as trigger_later(), but fails deferred with err"""
+    IOLoop.current().add_callback(partial(deferred.error, err))
+
+
+def resolved(value=None):
+    """Return Deferred triggered with value on the next iteration"""
+    deferred = Deferred()
+    trigger_later(deferred, value)
+    return deferred
+
+
+def sleep(seconds):
+    """Return Deferred which is triggered after `seconds`"""
+    deferred = Deferred()
+    IOLoop.current().add_timeout(time.time() + seconds,
+                                 partial(deferred.trigger, None))
+    return deferred
+
+
+class PeriodicRound(object):
+    """Call func every `interval` seconds in the background.
+
+    func should return an yieldable chain (e.g. be `asynchronous`).
+    A round is skipped while the previous one is still running,
+    so slow rounds don't pile up.
+    """
+    def __init__(self, func, interval):
+        self.func = func
+        self.running = False
+        self._callback = PeriodicCallback(self.run, interval * 1000)
+
+    def start(self, now=False):
+        """Start the rounds, the first one right away if now is set"""
+        self._callback.start()
+        if now:
+            IOLoop.current().add_callback(self.run)
+
+    def run(self):
+        if self.running:
+            return
+        self.running = True
+        self.func().then(self._finished)
+
+    def _finished(self, result):
+        self.running = False
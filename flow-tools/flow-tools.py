@@ -20,30 +20,61 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-import cStringIO
+import time
 import uuid
 
 import msgpack
+from tornado.ioloop import IOLoop
 
 from cocaine.services import Service
 from cocaine.asio.service import Locator
 from cocaine.worker import Worker
 from cocaine.asio.engine import asynchronous
+from cocaine.exceptions import ServiceError
 from cocaine.logging import Logger
 from cocaine.tools.actions import profile
 from cocaine.tools.actions import runlist
 from cocaine.tools.actions import group
-from cocaine.tools.actions import crashlog
 from cocaine.tools.actions import app
 
 
+import compression
+from crashlogindex import CrashlogIndex
+from crashlogindex import CRASHLOGS_NAMESPACE
+from crashlogindex import DEFAULT_PAGE_LIMIT
+from crashstats import CrashStats
+from crashstats import DEFAULT_TOP
+from crashstats import MINUTE
+from fanout import bounded_map
 from userdb import UserDB
+from userdb import is_not_found
+from userdb import lost_segment
+from userdb import resolve_range
 from hostdb import HostDB
 from nodecluster import NodeCluster
+from nodecluster import DEFAULT_PARALLEL
+from nodecluster import DEFAULT_HOST_TIMEOUT
+from nodecluster import resolve_count
+from nodepool import NodePool
+from nodepool import LOCATOR
+from appinfo import AppInfoCollector
+from health import HealthTracker
 
 ITEM_IS_ABSENT = -100
+UNKNOWN_ERROR = -99
 VERSION_DELEMITER = "_"
 
+GROUP_REFRESH_PARALLEL = 50
+GROUP_REFRESH_TIMEOUT = 30  # seconds
+
+# upload log is sent to the client once this much piled up
+# or the interval passed
+UPLOAD_LOG_FLUSH_SIZE = 4096
+UPLOAD_LOG_FLUSH_INTERVAL = 0.1  # seconds
+
+# lines of a crashlog are streamed by chunks of this size
+CRASHLOG_CHUNK_SIZE = 64 * 1024
+
 log = Logger()
 storage = Service("storage")
 locator = Locator()
@@ -52,31 +83,59 @@ LOGS_NAMESPACE = "flow_upload_logs"
 HOSTS_NAMESPACE = "flow_hosts"
 db = UserDB(storage, "KEY", "flow_users")
 hostdb = HostDB(storage, HOSTS_NAMESPACE)
+# connections to nodes and apps on cluster hosts
+nodepool = NodePool()
+appinfo = AppInfoCollector(nodepool)
+# probes have their own connections, so timed out ones
+# don't close connections used by requests
+health = HealthTracker(hostdb, NodePool())
+crashlogs = CrashlogIndex(storage)
+crashstats = CrashStats(storage, crashlogs)
 
 
 class UploadLog(object):
-    def __init__(self, depth=10, on_flush=None):
+    """Coalesces lines of a build log.
+
+    Lines are flushed once `size` bytes piled up or `interval`
+    seconds passed since the first of them was written.
+    """
+    def __init__(self, size=UPLOAD_LOG_FLUSH_SIZE,
+                 interval=UPLOAD_LOG_FLUSH_INTERVAL,
+                 on_flush=None, store=None):
         self.current = list()
-        self.buffer = cStringIO.StringIO()
-        self.depth = depth
+        self.buffered = 0
+        # flushed lines go to the store (e.g. BuildlogWriter)
+        self.store = store
+        self.size = size
+        self.interval = interval
         self.on_flush = on_flush
+        self._timeout = None
 
     def write(self, value):
-
-        self.current.append("%s\n" % value)
-        if len(self.current) >= self.depth:
+        line = "%s\n" % value
+        self.current.append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.size:
             self.flush()
+        elif self._timeout is None:
+            self._timeout = IOLoop.current().add_timeout(
+                time.time() + self.interval, self.flush)
 
     def flush(self):
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        if not self.current:
+            return
+
         data = ''.join(self.current)
-        self.buffer.write(data)
         self.current = list()
+        self.buffered = 0
+        if self.store is not None:
+            self.store.write(data)
         if self.on_flush is not None:
             self.on_flush(data)
 
-    def getall(self):
-        return self.buffer.getvalue()
-
 
 def unpacker(decoder):
     def dec(func):
@@ -102,6 +161,16 @@ def appname_from_name_version(name, version):
     return "%s_%s" % (name, version)
 
 
+def alive_hosts(hosts, logcallback):
+    """Drop hosts which are known to be down"""
+    alive, down = health.split(hosts)
+    for host in down:
+        line = "Skip host %s as it's down\n" % host
+        log.info(line)
+        logcallback(line)
+    return alive
+
+
 # profiles
 @unpacker(msgpack.unpackb)
 @asynchronous
@@ -211,6 +280,18 @@ def host_list(_, response):
         response.close()
 
 
+@unpacker(msgpack.unpackb)
+@asynchronous
+def host_health(_, response):
+    try:
+        response.write(health.dump())
+    except Exception as err:
+        log.error(str(err))
+        response.error(-100, "Unable to read health of hosts")
+    finally:
+        response.close()
+
+
 @unpacker(msgpack.unpackb)
 @asynchronous
 def host_add(name, response):
@@ -321,16 +402,38 @@ def group_popapp(info, response):
 
 @unpacker(msgpack.unpackb)
 @asynchronous
-def group_refresh(name, response):
+def group_refresh(task, response):
+    # either a name of the group or a list of names
+    names = task if isinstance(task, (list, tuple)) else [task]
+
+    @asynchronous
+    def refresh_at(host_locator):
+        for name in names:
+            yield group.Refresh(host_locator, storage, name).execute()
+        yield True
+
+    def refresh(host):
+        return nodepool.call(host, LOCATOR, GROUP_REFRESH_TIMEOUT, refresh_at)
+
     try:
         hosts = yield hostdb.hosts()
-        for host in hosts:
-            l = Locator()
-            l.connect(host, 10053, 120, True)
-            yield group.Refresh(l, storage, name).execute()
+        hosts, down = health.split(hosts)
+        results = yield bounded_map(refresh, hosts,
+                                    GROUP_REFRESH_PARALLEL,
+                                    GROUP_REFRESH_TIMEOUT)
+        status = dict((host, "host is down") for host in down)
+        for host, res in zip(hosts, results):
+            if isinstance(res, Exception):
+                log.error("Unable to refresh %s at host %s: %s"
+                          % (names, host, repr(res)))
+                status[host] = str(res) or res.__class__.__name__
+            else:
+                status[host] = "ok"
     except Exception as err:
         log.error(repr(err))
         response.error(-100, "Unable to refresh %s" % err)
+    else:
+        response.write(status)
     finally:
         response.close()
 
@@ -340,24 +443,98 @@ def group_refresh(name, response):
 @asynchronous
 def crashlog_list(name, response):
     try:
-        crashlogs = yield crashlog.List(storage, name).execute()
+        entries = yield crashlogs.entries(name)
     except Exception as err:
         log.error(repr(err))
         response.error(-100, "Unknown error")
     else:
-        response.write(crashlogs)
+        response.write([key for _, key in entries])
     finally:
         response.close()
 
 
+@unpacker(msgpack.unpackb)
+@asynchronous
+def crashlog_query(info, response):
+    """Write a page of crashlogs {"crashlogs", "next"}, the newest first"""
+    try:
+        limit = info.get("limit") or DEFAULT_PAGE_LIMIT
+        page = yield crashlogs.query(info["name"],
+                                     since=info.get("since"),
+                                     until=info.get("until"),
+                                     limit=limit,
+                                     cursor=info.get("cursor"))
+    except ValueError as err:
+        response.error(-400, str(err))
+    except Exception as err:
+        log.error(repr(err))
+        response.error(-100, "Unknown error %s" % err)
+    else:
+        response.write(page)
+    finally:
+        response.close()
+
+
+@unpacker(msgpack.unpackb)
+@asynchronous
+def crashlog_top(info, response):
+    """Write [{"app", "crashes"}] of the most crashing apps"""
+    try:
+        top = crashstats.top(info.get("resolution") or MINUTE,
+                             info.get("window"),
+                             info.get("limit") or DEFAULT_TOP)
+    except ValueError as err:
+        response.error(-400, str(err))
+    except Exception as err:
+        log.error(repr(err))
+        response.error(-100, "Unknown error %s" % err)
+    else:
+        response.write(top)
+    finally:
+        response.close()
+
+
+@unpacker(msgpack.unpackb)
+@asynchronous
+def crashlog_rate(info, response):
+    """Write crashes of an app by time buckets"""
+    try:
+        rate = crashstats.rate(info["name"],
+                               info.get("resolution") or MINUTE,
+                               info.get("window"))
+    except ValueError as err:
+        response.error(-400, str(err))
+    except Exception as err:
+        log.error(repr(err))
+        response.error(-100, "Unknown error %s" % err)
+    else:
+        response.write(rate)
+    finally:
+        response.close()
+
+
+@asynchronous
+def read_crashlog(keys):
+    """Return lines of crashlogs stored under given keys"""
+    lines = list()
+    for key in keys:
+        data = yield storage.read(CRASHLOGS_NAMESPACE, key)
+        lines.extend(msgpack.unpackb(compression.unpack(data)))
+    yield lines
+
+
 @unpacker(msgpack.unpackb)
 @asynchronous
 def crashlog_view(info, response):
     try:
         name = info['name']
         timestamp = info['timestamp']
-        data = yield crashlog.View(storage, name, timestamp).execute()
-        encoded = msgpack.unpackb(data)
+        keys = yield crashlogs.find(name, timestamp)
+        if not keys:
+            response.error(ITEM_IS_ABSENT, "Crashlog %s of %s is missing"
+                           % (timestamp, name))
+            return
+        encoded = yield read_crashlog(keys)
     except Exception as err:
         log.error(repr(err))
         response.error(-100, "Unknown error %s" % err)
@@ -367,6 +544,47 @@ def crashlog_view(info, response):
         response.close()
 
 
+@unpacker(msgpack.unpackb)
+@asynchronous
+def crashlog_stream(info, response):
+    """Write the crashlog as text by chunks of CRASHLOG_CHUNK_SIZE"""
+    try:
+        name = info['name']
+        timestamp = info['timestamp']
+        keys = yield crashlogs.find(name, timestamp)
+        if not keys:
+            response.error(ITEM_IS_ABSENT, "Crashlog %s of %s is missing"
+                           % (timestamp, name))
+            return
+        try:
+            lines = yield read_crashlog(keys)
+        except ServiceError as err:
+            if not is_not_found(err):
+                raise
+            # removed by cleaning after it has been found
+            response.error(ITEM_IS_ABSENT, "Crashlog %s of %s is missing"
+                           % (timestamp, name))
+            return
+
+        chunk = list()
+        chunk_size = 0
+        for i, line in enumerate(lines):
+            # lines are joined by "\n" as a whole
+            chunk.append(line if i == 0 else "\n" + line)
+            chunk_size += len(line) + 1
+            if chunk_size >= CRASHLOG_CHUNK_SIZE:
+                response.write("".join(chunk))
+                chunk = list()
+                chunk_size = 0
+        if chunk:
+            response.write("".join(chunk))
+    except Exception as err:
+        log.error(repr(err))
+        response.error(UNKNOWN_ERROR, "Unknown error %s" % err)
+    finally:
+        response.close()
+
+
 # Users
 @unpacker(msgpack.unpackb)
 @asynchronous
@@ -407,6 +625,17 @@ def user_remove(name, response):
     response.close()
 
 
+@unpacker(msgpack.unpackb)
+@asynchronous
+def user_remove_status(name, response):
+    try:
+        response.write(db.remove_jobs[name])
+    except KeyError:
+        response.error(ITEM_IS_ABSENT, "User %s isn't being removed" % name)
+    finally:
+        response.close()
+
+
 @unpacker(msgpack.unpackb)
 @asynchronous
 def user_list(_, response):
@@ -428,7 +657,8 @@ def user_upload(info, response):
         docker = info["docker"]
         registry = info["registry"]
 
-        buildlog = UploadLog(depth=5, on_flush=response.write)
+        logwriter = db.buildlog_writer(user, upload_ID)
+        buildlog = UploadLog(on_flush=response.write, store=logwriter)
         buildlog.write("User %s, app %s, id %s\n" % (user,
                                                      appname,
                                                      upload_ID))
@@ -438,8 +668,14 @@ def user_upload(info, response):
             if not user_exists:
                 raise ValueError("User %s doesn't exist" % user)
 
-            apps = yield app.List(storage).execute()
-            if appname in apps:
+            # the index misses apps uploaded bypassing flow until
+            # the repair finishes, an upload mustn't overwrite them.
+            # Uploads are rare and slow, so the cloud is asked too
+            all_apps = yield app.List(storage).execute()
+            app_exists = appname in all_apps
+            if not app_exists:
+                app_exists = yield db.app_exists(appname)
+            if app_exists:
                 log.error("App %s already exists" % appname)
                 raise ValueError("App %s already exists" % appname)
 
@@ -454,10 +690,13 @@ def user_upload(info, response):
             raise err
         finally:
             buildlog.flush()
-            logdata = buildlog.getall()
             log.debug("Saving uploadlog into storage")
-            yield db.write_buildlog(user, upload_ID, logdata)
-            log.debug("Uploadlog has been saved successfully")
+            lost = yield logwriter.close()
+            if lost:
+                log.error("Segments %s of uploadlog %s are lost"
+                          % (lost, upload_ID))
+            else:
+                log.debug("Uploadlog has been saved successfully")
         response.write("Done")
     except KeyError as err:
         response.error(-500, "Missing argument %s" % str(err))
@@ -478,24 +717,11 @@ def user_apps_list(username, response):
         except ValueError:
             return None
 
-    all_apps = yield app.List(storage).execute()
+    # index is kept consistent with the storage by db.repair()
     user_apps = yield db.user_apps(username)
 
-    set_all_apps = frozenset(all_apps)
-    set_user_apps = frozenset(user_apps)
-
-    res = None
-    if set_user_apps.issubset(set_all_apps):
-        res = user_apps
-    else:
-        diff = set_user_apps.difference(set_all_apps)
-        log.error("Application info is inconsistent %s" % ' '.join(diff))
-
-        inter = set_user_apps.intersection(set_all_apps)
-        res = inter
-
     response.write(filter(lambda x: x is not None,
-                          map(output, res)))
+                          map(output, user_apps)))
     response.close()
 
 
@@ -525,6 +751,68 @@ def user_buildlog_read(key, response):
         response.close()
 
 
+@unpacker(msgpack.unpackb)
+@asynchronous
+def user_buildlog_stream(task, response):
+    """Write {"size", "offset", "length", "encoding"} and then the log.
+
+    The log is written by segments. If the whole log is requested
+    with an encoding it's stored in, segments are sent compressed.
+    Segments which weren't stored are replaced with placeholders of
+    the same size.
+    """
+    try:
+        key = task["id"]
+        index = yield db.read_buildlog_index(key)
+        if isinstance(index, dict):
+            size = index["size"]
+        else:
+            size = len(index)
+        start, end = resolve_range(size, task.get("offset", 0),
+                                   task.get("length"))
+        encoding = None
+        whole = start == 0 and end == size
+        # compressed stream can't be passed with a gap in it
+        if isinstance(index, dict) and whole and not index.get("failed"):
+            stored = index.get("encoding")
+            if stored is not None and stored == task.get("encoding"):
+                encoding = stored
+        response.write({"size": size, "offset": start, "length": end - start,
+                        "encoding": encoding})
+
+        if encoding is not None:
+            for n in range(index["segments"]):
+                segment = yield db.read_buildlog_segment(key, n, raw=True)
+                response.write(segment)
+        elif not isinstance(index, dict):
+            if end > start:
+                response.write(index[start:end])
+        elif end > start:
+            segment_size = index["segment_size"]
+            lost = frozenset(index.get("failed", ()))
+            for n in range(start // segment_size,
+                           (end - 1) // segment_size + 1):
+                base = n * segment_size
+                if n in lost:
+                    segment = lost_segment(min(segment_size, size - base))
+                else:
+                    segment = yield db.read_buildlog_segment(key, n)
+                response.write(segment[max(0, start - base):end - base])
+    except KeyError as err:
+        response.error(-500, "Missing argument %s" % str(err))
+    except ServiceError as err:
+        if is_not_found(err):
+            response.error(ITEM_IS_ABSENT, "Buildlog %s is missing" % key)
+        else:
+            log.error(str(err))
+            response.error(UNKNOWN_ERROR, repr(err))
+    except Exception as err:
+        log.error(str(err))
+        response.error(UNKNOWN_ERROR, repr(err))
+    finally:
+        response.close()
+
+
 # apps
 
 @unpacker(msgpack.unpackb)
@@ -540,26 +828,19 @@ def app_info(task, response):
 
         if username:
             # not admin - all apps
-            user_apps = yield app.List(storage).execute()
+            app_exists = yield db.app_exists(appname)
         else:
             user_apps = yield db.user_apps(username)
+            app_exists = appname in user_apps
 
-        if appname not in user_apps:
+        if not app_exists:
             raise ValueError("App %s doesn't exist" % appname)
 
         hosts = yield hostdb.hosts()
-        for host in hosts:
-            appinstance = None
-            try:
-                appinstance = Service(appname, blockingConnect=False)
-                yield appinstance.connect(host=host)
-                info[host] = yield appinstance.info()
-            except Exception as err:
-                log.error("Unable to connect to app %s host %s" % (appname,
-                                                                   host))
-            finally:
-                if appinstance is not None:
-                    appinstance.disconnect()
+        hosts, down = health.split(hosts)
+        info = yield appinfo.collect(appname, hosts)
+        for host in down:
+            info[host] = {"error": "host is down"}
     except KeyError as err:
         response.error(-500, "Missing argument %s" % str(err))
     except Exception as err:
@@ -602,13 +883,31 @@ def app_deploy(task, response):
                                      appname,
                                      profilename, force=True).execute()
         hosts = yield hostdb.hosts()
-        cluster = NodeCluster(hosts, response.write)
-        (s, f) = yield cluster.start_app(appname, profilename)
+        hosts = alive_hosts(hosts, response.write)
+        cluster = NodeCluster(hosts, nodepool, response.write,
+                              task.get("parallel", DEFAULT_PARALLEL),
+                              task.get("timeout", DEFAULT_HOST_TIMEOUT))
+        batch = task.get("batch")
+        if batch:
+            max_failed = task.get("max_failed")
+            if max_failed is not None:
+                max_failed = resolve_count(max_failed, len(hosts))
+            (s, f, skipped) = yield cluster.rolling_start_app(
+                appname, profilename,
+                resolve_count(batch, len(hosts)),
+                task.get("pause", 0),
+                max_failed)
+        else:
+            (s, f) = yield cluster.start_app(appname, profilename)
+            skipped = list()
     except Exception as err:
         log.error("Unknown error %s" % repr(err))
         response.error(-100, "Unknown error %s" % repr(err))
     else:
-        response.write("Done")
+        if skipped:
+            response.write("Aborted")
+        else:
+            response.write("Done")
     finally:
         response.close()
 
@@ -623,7 +922,10 @@ def app_stop(task, response):
         version = task["version"]
         appname = appname_from_name_version(name, version)
         hosts = yield hostdb.hosts()
-        cluster = NodeCluster(hosts, response.write)
+        hosts = alive_hosts(hosts, response.write)
+        cluster = NodeCluster(hosts, nodepool, response.write,
+                              task.get("parallel", DEFAULT_PARALLEL),
+                              task.get("timeout", DEFAULT_HOST_TIMEOUT))
         (s, f) = yield cluster.stop_app(appname)
     except Exception as err:
         log.error("Unknown error %s" % repr(err))
@@ -645,7 +947,10 @@ def app_start(task, response):
         version = task["version"]
         appname = appname_from_name_version(name, version)
         hosts = yield hostdb.hosts()
-        cluster = NodeCluster(hosts, response.write)
+        hosts = alive_hosts(hosts, response.write)
+        cluster = NodeCluster(hosts, nodepool, response.write,
+                              task.get("parallel", DEFAULT_PARALLEL),
+                              task.get("timeout", DEFAULT_HOST_TIMEOUT))
         (s, f) = yield cluster.start_app(appname, profilename)
     except Exception as err:
         log.error("Unknown error %s" % repr(err))
@@ -669,6 +974,7 @@ binds = {
     # hosts
     "host-add": host_add,
     "host-list": host_list,
+    "host-health": host_health,
     "host-remove": host_remove,
     # groups
     "group-list": group_list,
@@ -681,16 +987,22 @@ binds = {
     # crashlogs
     "crashlog-list": crashlog_list,
     "crashlog-view": crashlog_view,
+    "crashlog-query": crashlog_query,
+    "crashlog-stream": crashlog_stream,
+    "crashlog-top": crashlog_top,
+    "crashlog-rate": crashlog_rate,
     # users
     "user-exists": user_exists,
     "user-signup": user_signup,
     "user-signin": user_signin,
     "user-remove": user_remove,
+    "user-remove-status": user_remove_status,
     "user-list": user_list,
     "user-upload": user_upload,
     "user-app-list": user_apps_list,
     "user-buildlog-list": user_buildlog_list,
     "user-buildlog-read": user_buildlog_read,
+    "user-buildlog-stream": user_buildlog_stream,
     # app
     "app-info": app_info,
     "app-deploy": app_deploy,
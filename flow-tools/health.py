@@ -0,0 +1,166 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import time
+from collections import deque
+
+from cocaine.asio.engine import asynchronous
+from cocaine.logging import Logger
+
+from fanout import bounded_map
+from fanout import PeriodicRound
+
+log = Logger()
+
+DEFAULT_PROBE_INTERVAL = 15  # seconds
+DEFAULT_PROBE_TIMEOUT = 5  # seconds
+DEFAULT_PROBE_PARALLEL = 50
+
+# consecutive failed probes after which host is considered down
+FAILURE_THRESHOLD = 3
+# host which changed its state that many times within the last
+# FLAP_WINDOW probes is flapping
+FLAP_WINDOW = 10
+FLAP_THRESHOLD = 4
+
+UNKNOWN = "unknown"
+UP = "up"
+DOWN = "down"
+FLAPPING = "flapping"
+
+
+class HostHealth(object):
+    def __init__(self):
+        self.state = UNKNOWN
+        self.failures = 0
+        self.history = deque(maxlen=FLAP_WINDOW)
+        self.last_probe = None
+        self.last_error = None
+        self.changed_at = time.time()
+
+    def record(self, ok, error=None):
+        self.history.append(ok)
+        self.last_probe = time.time()
+        if ok:
+            self.failures = 0
+            self.last_error = None
+        else:
+            self.failures += 1
+            self.last_error = error
+
+        history = list(self.history)
+        transitions = sum(1 for prev, cur in zip(history, history[1:])
+                          if prev != cur)
+        if transitions >= FLAP_THRESHOLD:
+            state = FLAPPING
+        elif self.failures >= FAILURE_THRESHOLD:
+            state = DOWN
+        elif ok:
+            state = UP
+        else:
+            # single failures don't change the state
+            state = self.state
+
+        if state != self.state:
+            self.state = state
+            self.changed_at = self.last_probe
+        return state
+
+    def dump(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "last_probe": self.last_probe,
+            "last_error": self.last_error,
+            "changed_at": self.changed_at,
+        }
+
+
+class HealthTracker(object):
+    """Probes node service of every host in background.
+
+    Hosts which are down are skipped by fan-out operations until
+    a probe succeeds again, flapping ones go last.
+    """
+    def __init__(self, hostdb, nodepool,
+                 interval=DEFAULT_PROBE_INTERVAL,
+                 timeout=DEFAULT_PROBE_TIMEOUT,
+                 parallel=DEFAULT_PROBE_PARALLEL):
+        self.hostdb = hostdb
+        self.nodepool = nodepool
+        self.timeout = timeout
+        self.parallel = parallel
+        self._health = dict()
+        self._prober = PeriodicRound(self.probe, interval)
+        self._prober.start()
+
+    def state(self, host):
+        health = self._health.get(host)
+        return health.state if health is not None else UNKNOWN
+
+    def split(self, hosts):
+        """Return (hosts to use, down hosts)"""
+        alive = list()
+        flapping = list()
+        down = list()
+        for host in hosts:
+            state = self.state(host)
+            if state == DOWN:
+                down.append(host)
+            elif state == FLAPPING:
+                flapping.append(host)
+            else:
+                alive.append(host)
+        return alive + flapping, down
+
+    @asynchronous
+    def probe(self):
+        try:
+            hosts = yield self.hostdb.hosts()
+            for host in list(self._health):
+                if host not in hosts:
+                    del self._health[host]
+
+            results = yield bounded_map(self._probe, hosts,
+                                        self.parallel, self.timeout)
+            for host, res in zip(hosts, results):
+                health = self._health.setdefault(host, HostHealth())
+                prev = health.state
+                if isinstance(res, Exception):
+                    reason = str(res) or res.__class__.__name__
+                    state = health.record(False, reason)
+                else:
+                    state = health.record(True)
+                if state != prev:
+                    log.info("Host %s is %s now" % (host, state))
+        except Exception as err:
+            log.error("Unable to probe hosts: %s" % err)
+
+    @asynchronous
+    def _probe(self, host):
+        yield self.nodepool.call(host, "node", self.timeout,
+                                 lambda node: node.list())
+        yield True
+
+    def dump(self):
+        return dict((host, health.dump())
+                    for host, health in self._health.items())
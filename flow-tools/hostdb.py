@@ -19,32 +19,102 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+
+import time
+
 from cocaine.asio.engine import asynchronous
+from cocaine.futures import Deferred
 from cocaine.logging import Logger
 
+from fanout import trigger_later
+
 namespace_prefix = "flow-users@"
 HOSTS_TAG = ["flow-host"]
 
+# the list is reloaded from the storage in background after that,
+# as hosts could be changed by other flow-tools instances
+DEFAULT_REFRESH_INTERVAL = 60  # seconds
+
 logger = Logger()
 
 namespace_prefix = "flow-hosts@"
 
 
 class HostDB(object):
-    def __init__(self, storage, namespace):
+    def __init__(self, storage, namespace,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL):
         self.namespace = namespace_prefix + namespace
         self.storage = storage
+        self.refresh_interval = refresh_interval
+        # in-memory copy of the host list, None until the first load
+        self._hosts = None
+        self._loaded_at = 0
+        # add/remove made while loading, applied on top of the result
+        self._changes = None
+        self._waiters = list()
 
-    @asynchronous
     def hosts(self):
-        yield self.storage.find(self.namespace, HOSTS_TAG)
+        """Return Deferred triggered with the list of hosts.
+
+        Only the first call waits for the storage. Later ones are
+        served from memory, stale list triggers a background reload.
+        """
+        deferred = Deferred()
+        if self._hosts is not None:
+            trigger_later(deferred, list(self._hosts))
+        else:
+            self._waiters.append(deferred)
+
+        stale = time.time() - self._loaded_at > self.refresh_interval
+        if self._changes is None and (self._hosts is None or stale):
+            self._changes = list()
+            self._load()
+        return deferred
+
+    @asynchronous
+    def _load(self):
+        try:
+            hosts = yield self.storage.find(self.namespace, HOSTS_TAG)
+        except Exception as err:
+            logger.error("Unable to load hosts: %s" % err)
+            self._changes = None
+            waiters, self._waiters = self._waiters, list()
+            for deferred in waiters:
+                deferred.error(err)
+            return
+
+        hosts = list(hosts)
+        for add, hostname in self._changes:
+            if add and hostname not in hosts:
+                hosts.append(hostname)
+            elif not add and hostname in hosts:
+                hosts.remove(hostname)
+        self._changes = None
+        self._hosts = hosts
+        self._loaded_at = time.time()
+
+        waiters, self._waiters = self._waiters, list()
+        for deferred in waiters:
+            deferred.trigger(list(hosts))
+
+    def _update(self, add, hostname):
+        if self._changes is not None:
+            self._changes.append((add, hostname))
+        if self._hosts is None:
+            return
+        if add and hostname not in self._hosts:
+            self._hosts.append(hostname)
+        elif not add and hostname in self._hosts:
+            self._hosts.remove(hostname)
 
     @asynchronous
     def add(self, hostname):
         yield self.storage.write(self.namespace, hostname,
                                  hostname, HOSTS_TAG)
+        self._update(True, hostname)
 
     @asynchronous
     def remove(self, hostname):
         yield self.storage.remove(self.namespace,
                                   hostname)
+        self._update(False, hostname)
@@ -19,80 +19,162 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-from cocaine.services import Service
+from functools import partial
+import math
+
 from cocaine.asio.engine import asynchronous
 from cocaine.logging import Logger
 
 from cocaine.tools.actions import app
 
+from fanout import bounded_map
+from fanout import sleep
+
 log = Logger()
 
+DEFAULT_PARALLEL = 10
+DEFAULT_HOST_TIMEOUT = 120  # seconds
+
+
+def resolve_count(value, total):
+    """Convert an absolute number or a percentage like "25%" of total"""
+    if isinstance(value, basestring) and value.endswith("%"):
+        percent = float(value[:-1])
+        # at least one host, unless zero percent is asked
+        return int(math.ceil(total * percent / 100.0))
+    return int(value)
+
 
 class NodeCluster(object):
-    def __init__(self, hosts, logcallback):
+    def __init__(self, hosts, nodepool, logcallback,
+                 parallel=DEFAULT_PARALLEL, timeout=DEFAULT_HOST_TIMEOUT):
         self.hosts = hosts
+        self.nodepool = nodepool
         self.logcallback = logcallback
+        self.parallel = max(1, parallel)
+        self.timeout = timeout
 
     @asynchronous
     def start_app(self, appname, profilename):
-        success = list()
-        failed = list()
-        hosts_count = len(self.hosts)
-        for i, host in enumerate(self.hosts):
-            item = "Start %s at host %d/%d %s\n" % (appname,
-                                                    i + 1, hosts_count,
-                                                    host)
-            log.info(item)
-            self.logcallback(item)
-            nodeinstance = None
-            try:
-                nodeinstance = Service("node", blockingConnect=False)
-                yield nodeinstance.connect(host=host)
-                res = yield app.Start(nodeinstance,
-                                      appname,
-                                      profilename).execute()
-                self.logcallback(str(res) + '\n')
-            except Exception as e:
-                item = "Unable to connect to node at host %s %s\n" % (host, e)
-                log.error(item)
-                self.logcallback(item)
-                failed.append(host)
-            else:
-                item = "App %s has been launched successfully\n" % appname
-                log.info(item)
-                self.logcallback(item)
-                success.append(host)
-            finally:
-                if nodeinstance is not None:
-                    nodeinstance.disconnect()
-        yield (success, failed)
+        start = partial(self._start_at, appname, profilename, len(self.hosts))
+        results = yield bounded_map(start, enumerate(self.hosts),
+                                    self.parallel, self.timeout)
+        yield self._split(self.hosts, results)
 
     @asynchronous
-    def stop_app(self, appname):
+    def rolling_start_app(self, appname, profilename,
+                          batch_size, pause=0, max_failed=None):
+        """Start the app batch by batch.
+
+        Batches of `batch_size` hosts are started one after another
+        with `pause` seconds between them. If more than `max_failed`
+        hosts have failed the rest of batches are skipped.
+        Returns (succeed, failed, skipped).
+        """
+        hosts_count = len(self.hosts)
+        batch_size = max(1, batch_size)
+        items = list(enumerate(self.hosts))
+        batches = [items[i:i + batch_size]
+                   for i in range(0, hosts_count, batch_size)]
+        start = partial(self._start_at, appname, profilename, hosts_count)
+
         succeed = list()
         failed = list()
+        skipped = list()
+        for n, batch in enumerate(batches):
+            line = "Start batch %d/%d of %d hosts\n" % (n + 1, len(batches),
+                                                        len(batch))
+            log.info(line)
+            self.logcallback(line)
+            results = yield bounded_map(start, batch,
+                                        self.parallel, self.timeout)
+            s, f = self._split([host for _, host in batch], results)
+            succeed.extend(s)
+            failed.extend(f)
+
+            left = [host for b in batches[n + 1:] for _, host in b]
+            if not left:
+                break
+
+            if max_failed is not None and len(failed) > max_failed:
+                skipped = left
+                line = ("Abort deploy: %d hosts failed, the limit is %d. "
+                        "%d hosts are skipped\n" % (len(failed), max_failed,
+                                                    len(skipped)))
+                log.error(line)
+                self.logcallback(line)
+                break
+
+            if pause > 0:
+                yield sleep(pause)
+        yield succeed, failed, skipped
+
+    @asynchronous
+    def _start_at(self, appname, profilename, hosts_count, item):
+        i, host = item
+        line = "Start %s at host %d/%d %s\n" % (appname,
+                                                i + 1, hosts_count,
+                                                host)
+        log.info(line)
+        self.logcallback(line)
+        try:
+            res = yield self.nodepool.call(
+                host, "node", self.timeout,
+                lambda node: app.Start(node, appname, profilename).execute())
+            self.logcallback(str(res) + '\n')
+        except Exception as e:
+            line = "Unable to connect to node at host %s %s\n" % (host, e)
+            log.error(line)
+            self.logcallback(line)
+            yield False
+        else:
+            line = "App %s has been launched successfully\n" % appname
+            log.info(line)
+            self.logcallback(line)
+            yield True
+
+    @asynchronous
+    def stop_app(self, appname):
         hosts_count = len(self.hosts)
-        for i, host in enumerate(self.hosts):
+
+        @asynchronous
+        def stop(item):
+            i, host = item
             log.info("Stop %s at host %d/%d %s" % (appname,
-                                                   i, hosts_count,
+                                                   i + 1, hosts_count,
                                                    host))
-            nodeinstance = None
             try:
-                nodeinstance = Service("node", blockingConnect=False)
-                yield nodeinstance.connect(host=host)
-                res = yield app.Stop(nodeinstance, appname).execute()
+                res = yield self.nodepool.call(
+                    host, "node", self.timeout,
+                    lambda node: app.Stop(node, appname).execute())
                 self.logcallback(str(res) + '\n')
             except Exception as e:
-                item = "Unable to connect to node at host %s %s\n" % (host, e)
-                log.error(item)
-                self.logcallback(item)
-                failed.append(host)
+                line = "Unable to connect to node at host %s %s\n" % (host, e)
+                log.error(line)
+                self.logcallback(line)
+                yield False
             else:
-                item = "App %s has been stoped successfully\n" % appname
-                log.info(item)
-                self.logcallback(item)
+                line = "App %s has been stoped successfully\n" % appname
+                log.info(line)
+                self.logcallback(line)
+                yield True
+
+        results = yield bounded_map(stop, enumerate(self.hosts),
+                                    self.parallel, self.timeout)
+        yield self._split(self.hosts, results)
+
+    def _split(self, hosts, results):
+        succeed = list()
+        failed = list()
+        for host, res in zip(hosts, results):
+            if res is True:
                 succeed.append(host)
-            finally:
-                if nodeinstance is not None:
-                    nodeinstance.disconnect()
-        yield (succeed, failed)
+                continue
+
+            if isinstance(res, Exception):
+                # host has been timed out
+                line = "Host %s hasn't responded: %s\n" % (host, res)
+                log.error(line)
+                self.logcallback(line)
+            failed.append(host)
+        return succeed, failed
@@ -0,0 +1,200 @@
+# encoding: utf-8
+#
+#    Copyright (c) 2013-2014+ Anton Tyurin <noxiouz@yandex.ru>
+#    Copyright (c) 2013-2014 Other contributors as noted in the AUTHORS file.
+#
+#    This file is part of Cocaine.
+#
+#    Cocaine is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Cocaine is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+from functools import partial
+
+from tornado.ioloop import IOLoop
+from tornado.ioloop import PeriodicCallback
+
+from cocaine.asio.exceptions import CommunicationError
+from cocaine.asio.service import Locator
+from cocaine.asio.service import LOCATOR_DEFAULT_PORT
+from cocaine.services import Service
+from cocaine.asio.engine import asynchronous
+from cocaine.exceptions import ConnectionError
+from cocaine.futures import Deferred
+from cocaine.logging import Logger
+
+from fanout import error_later
+from fanout import resolved
+
+log = Logger()
+
+DEFAULT_IDLE_TIMEOUT = 300  # seconds
+DEFAULT_CHECK_INTERVAL = 30  # seconds
+
+# name to get a locator connection of a host
+LOCATOR = "locator"
+
+# errors of the connection itself. Others (e.g. ServiceError) are
+# errors of an operation, the connection is fine after them
+TRANSPORT_ERRORS = (CommunicationError, ConnectionError, IOError)
+
+
+class NodePool(object):
+    """Long-lived connections to services on cluster hosts.
+
+    Connections are keyed by (host, service name) and shared by
+    all operations. Closed connections are reestablished on the next
+    get(), idle ones are closed by the periodic check. A connection
+    is busy from get() till release(), busy ones are never idle.
+    A broken connection is replaced in the pool at once, but it's
+    closed only when the last operation on it releases it.
+    """
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.idle_timeout = idle_timeout
+        # (host, name) -> [service, last used]
+        self._services = dict()
+        # service -> number of operations using it
+        self._users = dict()
+        # services removed from the pool, closed by the last release()
+        self._retired = set()
+        # (host, name) -> list of Deferreds waiting for the connection
+        self._connecting = dict()
+        self._checker = PeriodicCallback(self.check, check_interval * 1000)
+        self._checker.start()
+
+    def get(self, host, name, timeout=None):
+        """Return Deferred triggered with the connected Service.
+
+        The connection should be given back with release().
+        """
+        key = (host, name)
+        entry = self._services.get(key)
+        if entry is not None and entry[0].isConnected():
+            entry[1] = time.time()
+            service = entry[0]
+            self._users[service] = self._users.get(service, 0) + 1
+            return resolved(service)
+
+        deferred = Deferred()
+
+        waiters = self._connecting.get(key)
+        if waiters is not None:
+            # somebody is connecting already
+            waiters.append(deferred)
+            return deferred
+
+        self.discard(host, name)
+        self._connecting[key] = [deferred]
+        self._connect(key, timeout)
+        return deferred
+
+    def release(self, host, name, service, failed=False):
+        """Give back the connection, a failed one is discarded"""
+        users = self._users[service] - 1
+        if users:
+            self._users[service] = users
+        else:
+            del self._users[service]
+
+        entry = self._services.get((host, name))
+        if entry is not None and entry[0] is service:
+            entry[1] = time.time()
+            if failed:
+                self.discard(host, name)
+        elif service in self._retired and not users:
+            self._retired.remove(service)
+            service.disconnect()
+
+    @asynchronous
+    def call(self, host, name, timeout, func):
+        """Return the result of func(service) with a pooled connection.
+
+        The connection is discarded after a transport error or if
+        func hangs for more than `timeout` seconds. A connection which
+        replaced it is kept.
+        """
+        service = yield self.get(host, name, timeout)
+        released = list()
+
+        def release(failed=False):
+            if not released:
+                released.append(True)
+                self.release(host, name, service, failed)
+
+        io_loop = IOLoop.current()
+        timer = io_loop.add_timeout(time.time() + timeout,
+                                    partial(release, True))
+        try:
+            result = yield func(service)
+        except TRANSPORT_ERRORS:
+            release(failed=True)
+            raise
+        finally:
+            io_loop.remove_timeout(timer)
+            release()
+        if result is not None:
+            # NOTE: yielded None never resumes, the generator
+            # returns the last sent value instead
+            yield result
+
+    @asynchronous
+    def _connect(self, key, timeout):
+        host, name = key
+        service = None
+        try:
+            if name == LOCATOR:
+                service = Locator()
+                yield service.connect(host, LOCATOR_DEFAULT_PORT,
+                                      timeout, False)
+            else:
+                service = Service(name, blockingConnect=False)
+                yield service.connect(host=host, timeout=timeout)
+        except Exception as err:
+            if service is not None:
+                service.disconnect()
+            # connect could fail before waiters yield their Deferreds
+            for deferred in self._connecting.pop(key):
+                error_later(deferred, err)
+        else:
+            waiters = self._connecting.pop(key)
+            self._services[key] = [service, time.time()]
+            self._users[service] = len(waiters)
+            for deferred in waiters:
+                deferred.trigger(service)
+
+    def discard(self, host, name):
+        """Remove the connection from the pool, e.g. after an error on it.
+
+        It's closed right away unless some operation still uses it.
+        """
+        entry = self._services.pop((host, name), None)
+        if entry is None:
+            return
+        service = entry[0]
+        if service in self._users:
+            self._retired.add(service)
+        else:
+            service.disconnect()
+
+    def check(self):
+        now = time.time()
+        for (host, name), (service, last_used) in list(self._services.items()):
+            idle = service not in self._users
+            if not service.isConnected():
+                log.info("Connection to %s at %s is lost" % (name, host))
+                self.discard(host, name)
+            elif idle and now - last_used > self.idle_timeout:
+                log.debug("Close idle connection to %s at %s" % (name, host))
+                self.discard(host, name)
@@ -19,27 +19,138 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-import uuid
-import hashlib
+from collections import deque
+from collections import OrderedDict
 from functools import partial
+import random
+import time
+import uuid
 
 from Crypto.Hash import HMAC
 import msgpack
 
-
 from cocaine.asio.engine import asynchronous
+from cocaine.exceptions import ServiceError
+from cocaine.futures import Deferred
 from cocaine.logging import Logger
+from cocaine.tools.actions import app
+
+from compression import codec_for
+from compression import SegmentCompressor
+from compression import split_header
+from compression import unpack_segment
+from fanout import bounded_map
+from fanout import PeriodicRound
+from fanout import sleep
+from fanout import trigger_later
 
 namespace_prefix = "flow-users@"
 USER_TAG = ["FLOW_USER"]
 LOG_TAG = ["FLOW_UPLOAD_LOG"]
+LOG_SEGMENT_TAG = ["FLOW_UPLOAD_LOG_SEGMENT"]
+OWNER_TAG = ["FLOW_APP_OWNER"]
+
+# how often the app index is checked against apps in the storage
+DEFAULT_REPAIR_INTERVAL = 600  # seconds
 
 encoder = msgpack.packb
 decoder = msgpack.unpackb
 
+# versioned records are stored as {VERSION: n, VALUE: value}
+VERSION = "version"
+VALUE = "value"
+# upload logs are stored by segments of that size
+LOG_SEGMENT_SIZE = 256 * 1024
+# segments of an upload log written at once, the rest are queued
+MAX_PENDING_SEGMENTS = 4
+# fills segments of an upload log which failed to be stored
+LOST_SEGMENT = "[part of the log is lost]\n"
+# upload logs of a removed user are deleted that many at once
+REMOVE_PARALLEL = 20
+REMOVE_PROGRESS_STEP = 100
+# progress of that many recent removals is kept
+MAX_REMOVE_JOBS = 100
+# attempts of a concurrent update and the first delay between them
+CAS_ATTEMPTS = 5
+CAS_BACKOFF = 0.05  # seconds
+# storage has no error code for a missing key, backends tell it
+# by the message
+NOT_FOUND_REASONS = ("not been found", "not found", "No such file")
+
 logger = Logger()
 
 
+class ConcurrentUpdateError(Exception):
+    def __init__(self, namespace, key):
+        super(ConcurrentUpdateError, self).__init__(
+            "Unable to update %s %s: too many concurrent updates"
+            % (namespace, key))
+
+
+def is_not_found(err):
+    """Whether err of the storage means that the key doesn't exist"""
+    if not isinstance(err, ServiceError):
+        return False
+    return any(reason in str(err.msg) for reason in NOT_FOUND_REASONS)
+
+
+def segment_key(key, n):
+    return "%s.%d" % (key, n)
+
+
+def segment_tags(user):
+    # segments mustn't be found by the tags of upload logs
+    return LOG_SEGMENT_TAG + ["segments@%s" % user]
+
+
+def lost_segment(length):
+    """Placeholder of `length` bytes for a segment which wasn't stored"""
+    return (LOST_SEGMENT * (length // len(LOST_SEGMENT) + 1))[:length]
+
+
+def resolve_range(size, offset=0, length=None):
+    """Return [start, end) of `size` bytes.
+
+    Negative offset counts from the end, length None means till the end.
+    """
+    start = max(0, size + offset) if offset < 0 else min(offset, size)
+    end = size if length is None else min(size, start + max(0, length))
+    return start, end
+
+
+def app_list(value):
+    """List of apps from a record of dbnamespace"""
+    if value is None:
+        return list()
+    if isinstance(value, (bytes, type(u""))):
+        # old records keep packed list
+        return msgpack.unpackb(value)
+    return list(value)
+
+
+class KeyLocks(object):
+    """Per-key FIFO locks for the IOLoop"""
+    def __init__(self):
+        # key -> Deferreds waiting for the lock, present if it's held
+        self._waiters = dict()
+
+    def acquire(self, key):
+        deferred = Deferred()
+        if key in self._waiters:
+            self._waiters[key].append(deferred)
+        else:
+            self._waiters[key] = deque()
+            trigger_later(deferred)
+        return deferred
+
+    def release(self, key):
+        waiters = self._waiters[key]
+        if waiters:
+            trigger_later(waiters.popleft())
+        else:
+            del self._waiters[key]
+
+
 class SecureStorage(object):
     def __init__(self, storage):
         self.storage = storage
@@ -66,13 +177,28 @@ class SecureStorage(object):
 
 
 class UserDB(object):
-    def __init__(self, storage, key, namespace):
+    def __init__(self, storage, key, namespace,
+                 repair_interval=DEFAULT_REPAIR_INTERVAL):
         self.storage = SecureStorage(storage)
         self.key = key
         self.logger = Logger()
         self.namespace = namespace_prefix + namespace
+        # user -> list of his apps
         self.dbnamespace = namespace_prefix + "apps"
+        # app -> owner
+        self.ownernamespace = namespace_prefix + "owners"
         self.lognamespace = namespace_prefix + "logs"
+        # apps which exist in the cloud, but haven't been
+        # uploaded through flow. Filled by repair()
+        self._unowned = frozenset()
+        # apps indexed while repair is running. They could be
+        # missing in its snapshot of the storage
+        self._fresh = set()
+        self._locks = KeyLocks()
+        # username -> progress of removal of his upload logs
+        self.remove_jobs = OrderedDict()
+        self._repairer = PeriodicRound(self.repair, repair_interval)
+        self._repairer.start(now=True)
         self.logger.info("UserDB has been initialized. Use namespace %s"
                          % self.namespace)
 
@@ -124,21 +250,79 @@ class UserDB(object):
         except Exception as err:
             self.logger.error(repr(err))
 
+        # the app list mustn't be changed between read and removal
+        yield self._locks.acquire((self.dbnamespace, name))
+        apps = list()
         try:
+            apps = yield self.user_apps(name)
             self.logger.info("Remove user %s application info" % name)
             yield self.storage.remove(self.dbnamespace, name)
         except Exception as err:
             self.logger.error(repr(err))
+        finally:
+            self._locks.release((self.dbnamespace, name))
+
+        for app_name in apps:
+            try:
+                owner = yield self.storage.read(self.ownernamespace, app_name)
+                if owner == name:
+                    self.logger.info("Remove owner of app %s" % app_name)
+                    yield self.storage.remove(self.ownernamespace, app_name)
+            except Exception as err:
+                self.logger.error("Unable to remove owner of app %s: %s"
+                                  % (app_name, repr(err)))
+        # apps are left in the cloud without an owner
+        self._unowned = self._unowned | frozenset(apps)
+
+        # there could be thousands of logs, so don't wait for them
+        job = {
+            "started": time.time(),
+            "total": None,
+            "removed": 0,
+            "failed": 0,
+            "done": False,
+        }
+        self.remove_jobs.pop(name, None)
+        self.remove_jobs[name] = job
+        while len(self.remove_jobs) > MAX_REMOVE_JOBS:
+            self.remove_jobs.popitem(last=False)
+        self._remove_logs(name, job)
+
+    @asynchronous
+    def _remove_logs(self, name, job):
+        @asynchronous
+        def remove(key):
+            try:
+                yield self.storage.remove(self.lognamespace, key)
+                job["removed"] += 1
+            except Exception as err:
+                self.logger.error("Unable to remove upload log %s: %s"
+                                  % (key, repr(err)))
+                job["failed"] += 1
+            processed = job["removed"] + job["failed"]
+            if processed % REMOVE_PROGRESS_STEP == 0:
+                self.logger.info("Removed %d/%d upload logs of user %s"
+                                 % (processed, job["total"], name))
+            yield True
 
         try:
             self.logger.info("Remove user %s upload logs" % name)
             tags = LOG_TAG + [name]
             logkeys = yield self.storage.find(self.lognamespace, tags)
+            segkeys = yield self.storage.find(self.lognamespace,
+                                              segment_tags(name))
             self.logger.debug("Uploadlogs keys %s" % logkeys)
-            for key in logkeys:
-                yield self.storage.remove(self.lognamespace, key)
+            logkeys = list(logkeys) + list(segkeys)
+            job["total"] = len(logkeys)
+            yield bounded_map(remove, logkeys, REMOVE_PARALLEL)
         except Exception as err:
             self.logger.error(repr(err))
+        finally:
+            job["done"] = True
+            self.logger.info("Upload logs of user %s have been removed: "
+                             "%d removed, %d failed in %.1fs"
+                             % (name, job["removed"], job["failed"],
+                                time.time() - job["started"]))
 
     @asynchronous
     def login(self, name, password):
@@ -161,73 +345,302 @@ class UserDB(object):
     def user_apps(self, user):
         apps = list()
         try:
-            raw_apps = yield self.storage.read(self.dbnamespace, user)
-            apps = msgpack.unpackb(raw_apps)
+            _, value = yield self._read_versioned(self.dbnamespace, user)
+            apps = app_list(value)
         except Exception as err:
             self.logger.error(repr(err))
         finally:
             yield apps
 
     @asynchronous
-    def write_app_info(self, user, name):
-        def handler(data):
-            apps = list()
-            if data is None:
-                apps = list()
-            else:
-                apps = msgpack.unpackb(data)
+    def app_exists(self, name):
+        exists = name in self._unowned
+        if not exists:
+            try:
+                yield self.storage.read(self.ownernamespace, name)
+                exists = True
+            except Exception as err:
+                self.logger.debug("App %s has no owner: %s" % (name, err))
+        yield exists
 
+    @asynchronous
+    def write_app_info(self, user, name):
+        def handler(value):
+            apps = app_list(value)
             if name in apps:
                 self.logger.error("App %s already exists" % name)
                 return None
 
             apps.append(name)
-            return msgpack.packb(apps)
+            return apps
 
-        reader = partial(self.storage.read, self.dbnamespace, user)
-        writer = lambda result: self.storage.write(self.dbnamespace,
-                                                   user,
-                                                   result,
-                                                   USER_TAG)
-        yield self.quasi_atomic_write(reader, writer, handler)
+        # a lost upload would leave the app unowned
+        yield self.update(self.dbnamespace, user, handler, USER_TAG,
+                          verify=True)
+        yield self.storage.write(self.ownernamespace, name, user, OWNER_TAG)
+        self._unowned = self._unowned - frozenset([name])
+        self._fresh.add(name)
 
     @asynchronous
-    def write_buildlog(self, user, key, logdata):
+    def remove_app_info(self, user, names):
+        def handler(value):
+            apps = app_list(value)
+            left = [name for name in apps if name not in names]
+            if len(left) == len(apps):
+                return None
+            return left
+
+        yield self.update(self.dbnamespace, user, handler, USER_TAG)
+
+    @asynchronous
+    def repair(self):
+        """Make the app index consistent with apps in the storage.
+
+        Apps removed from the cloud are dropped from users' lists,
+        missing owner records are restored and stale ones removed.
+        """
+        self._fresh.clear()
+        try:
+            all_apps = yield app.List(self.storage.raw_storage()).execute()
+            all_apps = frozenset(all_apps)
+            owner_keys = yield self.storage.find(self.ownernamespace,
+                                                 OWNER_TAG)
+            owner_keys = frozenset(owner_keys)
+            users = yield self.users()
+
+            owned = dict()
+            for user in users:
+                # user_apps() hides read errors, their owners
+                # would be taken for stale
+                _, value = yield self._read_versioned(self.dbnamespace, user)
+                apps = app_list(value)
+                stale = [name for name in apps
+                         if name not in all_apps and name not in self._fresh]
+                if stale:
+                    self.logger.info("Remove apps %s of user %s from the "
+                                     "index as they don't exist anymore"
+                                     % (stale, user))
+                    yield self.remove_app_info(user, stale)
+                for name in apps:
+                    if name in all_apps:
+                        owned[name] = user
+
+            for name, user in owned.items():
+                if name not in owner_keys:
+                    self.logger.info("Restore owner %s of app %s"
+                                     % (user, name))
+                    yield self.storage.write(self.ownernamespace,
+                                             name, user, OWNER_TAG)
+
+            for name in owner_keys:
+                if name not in owned and name not in self._fresh:
+                    self.logger.info("Remove stale owner of app %s" % name)
+                    yield self.storage.remove(self.ownernamespace, name)
+
+            self._unowned = all_apps - frozenset(owned)
+        except Exception as err:
+            self.logger.error("Unable to repair app index: %s" % repr(err))
+
+    def buildlog_writer(self, user, key):
+        return BuildlogWriter(self, user, key)
+
+    @asynchronous
+    def write_buildlog_segment(self, user, key, n, data):
+        yield self.storage.write(self.lognamespace, segment_key(key, n),
+                                 data, segment_tags(user))
+
+    @asynchronous
+    def write_buildlog_index(self, user, key, index):
         tags = LOG_TAG + [user]
-        yield self.storage.write(self.lognamespace, key, logdata, tags)
+        yield self.storage.write(self.lognamespace, key, index, tags)
 
     @asynchronous
-    def read_buildlog(self, key):
+    def read_buildlog_index(self, key):
+        # dict for segmented logs, the log itself for older ones
         yield self.storage.read(self.lognamespace, key)
 
+    @asynchronous
+    def read_buildlog_segment(self, key, n, raw=False):
+        # raw returns compressed data as is, without the format header
+        record = yield self.storage.read(self.lognamespace,
+                                         segment_key(key, n))
+        if raw:
+            yield split_header(record)[1]
+        else:
+            yield unpack_segment(record, n)
+
+    @asynchronous
+    def read_buildlog(self, key):
+        index = yield self.read_buildlog_index(key)
+        if not isinstance(index, dict):
+            yield index
+            return
+
+        lost = frozenset(index.get("failed", ()))
+        segment_size = index["segment_size"]
+        segments = list()
+        for n in range(index["segments"]):
+            if n in lost:
+                length = min(segment_size, index["size"] - n * segment_size)
+                segment = lost_segment(length)
+            else:
+                segment = yield self.read_buildlog_segment(key, n)
+            segments.append(segment)
+        yield "".join(segments)
+
     @asynchronous
     def list_buildlog(self, user):
         tags = [user] if user else LOG_TAG
         yield self.storage.find(self.lognamespace, tags)
 
     @asynchronous
-    def quasi_atomic_write(self, reader, writer, handler):
-        while True:
-            data = None
-            summ = ""
-            try:
-                data = yield reader()
-                summ = hashlib.md5(data).hexdigest()
-            except Exception as err:
-                self.logger.error(repr(err))
-
-            result = handler(data)
-            if result is None:
-                break
-
-            try:
-                data = yield reader()
-            except Exception as err:
-                self.logger.error(repr(err))
+    def _read_versioned(self, namespace, key):
+        version, value = 0, None
+        try:
+            record = yield self.storage.read(namespace, key)
+        except ServiceError as err:
+            # other errors mustn't look like an empty record,
+            # it would be overwritten by the update
+            if not is_not_found(err):
+                raise
+            self.logger.debug("%s %s doesn't exist: %s" % (namespace, key,
+                                                           repr(err)))
+        else:
+            if isinstance(record, dict) and VERSION in record:
+                version, value = record[VERSION], record[VALUE]
+            else:
+                # written before records were versioned
+                value = record
+        yield version, value
 
-            if data is None or summ == hashlib.md5(data).hexdigest():
-                self.logger.info("MD5 is still valid. Do write")
-                yield writer(result)
-                break
+    @asynchronous
+    def update(self, namespace, key, handler, tags, verify=False):
+        """Read-modify-write of a versioned record.
+
+        handler(value) returns a new value or None to leave it as is.
+        Writers of the same key inside this worker are serialized, so
+        the record is read once and written with the next version.
+        The storage has no compare-and-swap against other workers:
+        with verify the record is read back after the write and the
+        update is retried with backoff if somebody else has changed it.
+        """
+        yield self._locks.acquire((namespace, key))
+        try:
+            delay = CAS_BACKOFF
+            for _ in range(CAS_ATTEMPTS):
+                version, value = yield self._read_versioned(namespace, key)
+                result = handler(value)
+                if result is None:
+                    break
+
+                record = {VERSION: version + 1, VALUE: result}
+                yield self.storage.write(namespace, key, record, tags)
+                if not verify:
+                    break
+                current, stored = yield self._read_versioned(namespace, key)
+                if current == version + 1 and stored == result:
+                    break
+
+                self.logger.info("%s %s has been changed concurrently. "
+                                 "Retry in %.2fs" % (namespace, key, delay))
+                yield sleep(delay * (1 + random.random()))
+                delay *= 2
+            else:
+                raise ConcurrentUpdateError(namespace, key)
+        finally:
+            self._locks.release((namespace, key))
+
+
+class BuildlogWriter(object):
+    """Stores upload log by segments of fixed size.
+
+    Filled segments are written in background, at most
+    MAX_PENDING_SEGMENTS at once. close() waits for them and writes
+    the index record {"segments", "size", "segment_size", "encoding",
+    "failed"} under the key of the log, "failed" lists segments which
+    weren't stored. Segments are compressed with the codec of the
+    namespace, if any.
+    """
+    def __init__(self, db, user, key, segment_size=LOG_SEGMENT_SIZE):
+        self.db = db
+        self.user = user
+        self.key = key
+        self.segment_size = segment_size
+        self.size = 0
+        self.segments = 0
+        self._buffer = list()
+        self._buffered = 0
+        # segments waiting for a write
+        self._queue = deque()
+        self._pending = 0
+        self._drained = None
+        self.failed = list()
+        self.encoding = codec_for(db.lognamespace)
+        self._compressor = None
+        if self.encoding is not None:
+            self._compressor = SegmentCompressor(self.encoding)
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.size += len(data)
+        if self._buffered < self.segment_size:
+            return
+
+        data = "".join(self._buffer)
+        while len(data) >= self.segment_size:
+            self._store(data[:self.segment_size])
+            data = data[self.segment_size:]
+        self._buffer = [data] if data else list()
+        self._buffered = len(data)
+
+    def _store(self, data, last=False):
+        if self._compressor is not None:
+            data = self._compressor.segment(data, last)
+        self._queue.append((self.segments, data))
+        self.segments += 1
+        self._write_queued()
+
+    def _write_queued(self):
+        while self._queue and self._pending < MAX_PENDING_SEGMENTS:
+            n, data = self._queue.popleft()
+            self._pending += 1
+            self.db.write_buildlog_segment(
+                self.user, self.key, n, data).then(partial(self._stored, n))
+
+    def _stored(self, n, result):
+        try:
+            result.get()
+        except Exception as err:
+            logger.error("Unable to write segment %d of upload log %s: %s"
+                         % (n, self.key, repr(err)))
+            self.failed.append(n)
+        self._pending -= 1
+        self._write_queued()
+        if self._pending == 0 and self._drained is not None:
+            drained, self._drained = self._drained, None
+            trigger_later(drained, True)
 
-            self.logger.info("MD5 mismatchs. Continue")
+    @asynchronous
+    def close(self):
+        """Store the rest of the log, return the list of lost segments"""
+        # compressed stream needs the last segment to be finished
+        # even if there is no data left
+        if self._buffer or self._compressor is not None:
+            self._store("".join(self._buffer), last=True)
+            self._buffer = list()
+            self._buffered = 0
+
+        if self._pending:
+            self._drained = Deferred()
+            yield self._drained
+
+        index = {
+            "segments": self.segments,
+            "size": self.size,
+            "segment_size": self.segment_size,
+            "encoding": self.encoding,
+            "failed": sorted(self.failed),
+        }
+        yield self.db.write_buildlog_index(self.user, self.key, index)
+        yield index["failed"]
@@ -45,7 +45,7 @@ setup(
     ],
     install_requires=[
         "cocaine >= 0.11.1.0",
-        "tornado >= 3.1",
+        "tornado >= 4.0",
         "cocaine-tools >= 0.11.4.0",
         "msgpack_python",
     ],
@@ -1,11 +1,50 @@
 import json
+import os
+import sys
 import urllib
 import time
+import unittest
+import zlib
 
 from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import AsyncTestCase
 from tornado.ioloop import IOLoop
 
+from cocaine.asio.engine import asynchronous
+from cocaine.asio.exceptions import TimeoutError
 from cocaine.flow.app import FlowRestServer
+from cocaine.flow.handlers.buildlogs import parse_range
+from cocaine.flow.token import Token
+from cocaine.futures import Deferred
+from cocaine.futures.chain import Chain
+
+# modules of flow-tools import each other by bare names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "flow-tools"))
+
+from compression import GZIP  # noqa
+from compression import SegmentCompressor  # noqa
+from compression import split_header  # noqa
+from compression import unpack_segment  # noqa
+from compression import WBITS  # noqa
+from compression import ZLIB  # noqa
+from crashlogindex import CrashlogIndex  # noqa
+from crashlogindex import MICROSECONDS  # noqa
+import crashstats  # noqa
+from crashstats import AppCrashStats  # noqa
+from crashstats import CrashStats  # noqa
+from crashstats import HOUR  # noqa
+from crashstats import MINUTE  # noqa
+from fanout import bounded_map  # noqa
+from fanout import error_later  # noqa
+from fanout import resolved  # noqa
+from fanout import sleep  # noqa
+import health  # noqa
+from health import HealthTracker  # noqa
+from health import HostHealth  # noqa
+from nodecluster import NodeCluster  # noqa
+from nodecluster import resolve_count  # noqa
+from userdb import resolve_range  # noqa
 
 test_runlist_name = "sometestrunlist"
 test_runlists = "{}"
@@ -159,6 +198,14 @@ class FlowTest(FlowTestCase):
         self.assertEqual(200, response.code)
 
         profiles = json.loads(response.body)
+
+        # conditional GET
+        etag = response.headers["Etag"]
+        response = self.fetch('/flow/v1/profiles/',
+                              headers={"Authorization": self.token,
+                                       "If-None-Match": etag})
+        self.assertEqual(304, response.code)
+
         for item in profiles:
             response = self.fetch('/flow/v1/profiles/%s' % item,
                                   headers={"Authorization": self.token})
@@ -177,6 +224,32 @@ class FlowTest(FlowTestCase):
         self.assertEqual(200, r.code, "Profile delete failed")
         self.assertEqual({}, json.loads(r.body))
 
+    @create_fake_user
+    def test_batch(self):
+        ops = [{"method": "profile_list"},
+               {"id": "add", "method": "host_add", "args": ["testHost"]},
+               {"method": "host_list", "after": ["add"]},
+               {"method": "unknown"}]
+        r = self.fetch('/flow/v1/batch',
+                       method="POST",
+                       body=json.dumps(ops[:3]),
+                       headers={"Authorization": self.token})
+        self.assertEqual(200, r.code)
+        results = json.loads(r.body)
+        self.assertEqual([0, "add", 2], [res["id"] for res in results])
+        self.assertIn('testHost', results[2]["result"])
+
+        r = self.fetch('/flow/v1/batch',
+                       method="POST",
+                       body=json.dumps(ops),
+                       headers={"Authorization": self.token})
+        self.assertEqual(400, r.code)
+
+        r = self.fetch('/flow/v1/hosts/' + "testHost",
+                       method="DELETE",
+                       headers={"Authorization": self.token})
+        self.assertEqual(200, r.code)
+
     @create_fake_user
     def test_host(self):
         r = self.fetch('/flow/v1/hosts/' + "testHost",
@@ -224,3 +297,550 @@ class FlowTestAuth(FlowTestCase):
                        method="DELETE",
                        headers={"Authorization": token})
         self.assertEqual(200, r.code)
+
+
+class FlowTestUtils(FlowTestCase):
+
+    def test_metrics(self):
+        # requests are recorded by handlers of flow, even rejected ones
+        r = self.fetch('/flow/v1/profiles/')
+        self.assertEqual(403, r.code)
+
+        r = self.fetch('/flow/v1/metrics')
+        self.assertEqual(200, r.code)
+        self.assertIn('flow_http_requests_total{route="ProfilesList",'
+                      'method="GET",code="403"} ', r.body)
+        self.assertIn('flow_http_request_duration_seconds_count'
+                      '{route="ProfilesList"} ', r.body)
+        self.assertIn('flow_executor_queue_depth{pool="unpack"} ', r.body)
+
+
+class TokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cipher = Token("aaaaaaaaaaaaaaaa")
+        self.user_info = {"name": "tokentest"}
+        self.token = self.cipher.pack_user(self.user_info)
+        self._time = time.time
+
+    def tearDown(self):
+        time.time = self._time
+
+    def test_cached(self):
+        self.assertEqual(self.user_info, self.cipher.valid(self.token))
+        self.assertEqual(self.user_info, self.cipher.valid(self.token))
+        self.assertEqual(1, self.cipher.hits)
+        self.assertEqual(1, self.cipher.misses)
+
+    def test_expired(self):
+        self.cipher.valid(self.token)
+        now = self._time()
+        time.time = lambda: now + 2 * 86400
+        self.assertRaises(ValueError, self.cipher.valid, self.token)
+        self.assertEqual(0, self.cipher.hits)
+        self.assertEqual(1, self.cipher.expirations)
+        self.assertEqual(0, self.cipher.cache_stats()["items"])
+
+    def test_tampered(self):
+        self.cipher.valid(self.token)
+        last = self.token[-1]
+        tampered = self.token[:-1] + ("0" if last != "0" else "1")
+        self.assertRaises(ValueError, self.cipher.valid, tampered)
+        self.assertEqual(0, self.cipher.hits)
+        self.assertEqual(2, self.cipher.misses)
+
+
+class FlowToolsTestCase(AsyncTestCase):
+    """Runs asynchronous code of flow-tools on the IOLoop of the test"""
+
+    def result(self, future):
+        # Deferred or the chain of an asynchronous call
+        if isinstance(future, Deferred):
+            deferred = future
+            future = Chain([lambda: deferred])
+        future.then(self.stop)
+        return self.wait().get()
+
+
+class FakeCrashlogStorage(object):
+
+    def __init__(self, crashlogs):
+        # app -> crashlog keys
+        self.crashlogs = crashlogs
+        self.finds = 0
+
+    def find(self, namespace, tags):
+        self.finds += 1
+        return resolved(list(self.crashlogs.get(tags[0], ())))
+
+
+class CrashlogIndexTest(FlowToolsTestCase):
+    # crashlog keys are "<timestamp in microseconds>:<uuid>"
+    keys = ["1412345678000001:b", "1412345678000001:a",
+            "1412345678999999:c", "1412345679000000:d",
+            "1412345680000000:e", "notacrashlog", "abc:f"]
+
+    def setUp(self):
+        super(CrashlogIndexTest, self).setUp()
+        self.storage = FakeCrashlogStorage({"testapp": list(self.keys)})
+        self.index = CrashlogIndex(self.storage)
+
+    def query(self, **kwargs):
+        return self.result(self.index.query("testapp", **kwargs))
+
+    def test_all(self):
+        page = self.query(limit=10)
+        self.assertEqual(["1412345680000000:e", "1412345679000000:d",
+                          "1412345678999999:c", "1412345678000001:b",
+                          "1412345678000001:a"], page["crashlogs"])
+        self.assertIsNone(page["next"])
+
+    def test_pages(self):
+        crashlogs = list()
+        cursor = None
+        for _ in range(3):
+            page = self.query(limit=2, cursor=cursor)
+            self.assertTrue(len(page["crashlogs"]) <= 2)
+            crashlogs.extend(page["crashlogs"])
+            cursor = page["next"]
+            if cursor is None:
+                break
+        self.assertIsNone(cursor)
+        # keys of the same microsecond are split between pages
+        self.assertEqual(self.query(limit=10)["crashlogs"], crashlogs)
+        self.assertEqual(1, self.storage.finds)
+
+    def test_since_until(self):
+        page = self.query(since=1412345679)
+        self.assertEqual(["1412345680000000:e", "1412345679000000:d"],
+                         page["crashlogs"])
+        page = self.query(until=1412345679)
+        self.assertEqual(["1412345678999999:c", "1412345678000001:b",
+                          "1412345678000001:a"], page["crashlogs"])
+        page = self.query(since=1412345679, until=1412345680, limit=1)
+        self.assertEqual(["1412345679000000:d"], page["crashlogs"])
+        self.assertIsNone(page["next"])
+
+    def test_invalid_cursor(self):
+        self.assertRaises(ValueError, self.query, cursor="bad")
+
+    def test_stale(self):
+        self.query()
+        self.storage.crashlogs["testapp"].append("1412345681000000:g")
+        app = self.index._apps["testapp"]
+
+        # a stale list is returned at once and reloaded in background
+        app.loaded_at -= self.index.refresh_interval + 1
+        page = self.query(limit=1)
+        self.assertEqual(["1412345680000000:e"], page["crashlogs"])
+        while app.loading:
+            self.io_loop.add_callback(self.stop)
+            self.wait()
+        self.assertEqual(2, self.storage.finds)
+        page = self.query(limit=1)
+        self.assertEqual(["1412345681000000:g"], page["crashlogs"])
+
+        # a list older than max_stale isn't returned
+        self.storage.crashlogs["testapp"].append("1412345682000000:h")
+        app.loaded_at -= self.index.max_stale + 1
+        page = self.query(limit=1)
+        self.assertEqual(["1412345682000000:h"], page["crashlogs"])
+        self.assertEqual(3, self.storage.finds)
+
+
+def crashlog_key(timestamp, uuid):
+    return "%d:%s" % (int(timestamp * MICROSECONDS), uuid)
+
+
+class AppCrashStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1412345678
+        self.stats = AppCrashStats()
+
+    def crash(self, ago, uuid):
+        self.stats.crash(uuid, self.now - ago, self.now)
+
+    def test_buckets(self):
+        self.crash(10, "a")
+        self.crash(70, "b")
+        self.crash(4000, "c")
+        # out of the history
+        self.crash(8 * 86400, "d")
+        self.assertEqual(1, self.stats.count(MINUTE, 1, self.now))
+        self.assertEqual(2, self.stats.count(MINUTE, 60, self.now))
+        self.assertEqual(3, self.stats.count(HOUR, 7 * 24, self.now))
+
+        series = self.stats.series(MINUTE, 3, self.now)
+        self.assertEqual([[1412345520, 0], [1412345580, 1],
+                          [1412345640, 1]], series)
+
+    def test_counted_once(self):
+        self.crash(10, "a")
+        self.crash(10, "a")
+        self.assertEqual(1, self.stats.count(MINUTE, 60, self.now))
+
+    def test_expire(self):
+        self.crash(10, "a")
+        self.crash(4000, "b")
+        self.stats.expire(self.now + 3600)
+        self.assertEqual(0, self.stats.count(MINUTE, 60, self.now + 3600))
+        self.assertEqual(2, self.stats.count(HOUR, 7 * 24, self.now + 3600))
+        self.assertFalse(self.stats.empty())
+
+        self.stats.expire(self.now + 8 * 86400)
+        self.assertTrue(self.stats.empty())
+        self.assertEqual({}, self.stats.seen)
+
+
+class FakeAppList(object):
+    apps = list()
+
+    def __init__(self, storage):
+        pass
+
+    def execute(self):
+        return resolved(list(self.apps))
+
+
+class CrashStatsTest(FlowToolsTestCase):
+
+    def setUp(self):
+        super(CrashStatsTest, self).setUp()
+        now = time.time()
+        self.storage = FakeCrashlogStorage({
+            "crashing": [crashlog_key(now - 10, "a"),
+                         crashlog_key(now - 70, "b")],
+            "quiet": [crashlog_key(now - 8 * 86400, "c")],
+            "clean": [],
+        })
+        self._list = crashstats.app.List
+        crashstats.app.List = FakeAppList
+        FakeAppList.apps = ["crashing", "quiet", "clean"]
+        self.index = CrashlogIndex(self.storage)
+        self.stats = CrashStats(self.storage, self.index)
+
+    def tearDown(self):
+        crashstats.app.List = self._list
+        super(CrashStatsTest, self).tearDown()
+
+    def test_sweep(self):
+        self.result(self.stats.sweep())
+        self.assertEqual([{"app": "crashing", "crashes": 2}],
+                         self.stats.top())
+        self.assertEqual(["crashing"], list(self.stats._stats))
+
+        # apps removed from the cloud are dropped
+        FakeAppList.apps = ["quiet", "clean"]
+        self.result(self.stats.sweep())
+        self.assertEqual([], self.stats.top())
+
+    def test_removed_crashlogs(self):
+        self.result(self.stats.sweep())
+        crashlogs = self.storage.crashlogs["crashing"]
+        crashlogs[:] = [crashlog_key(time.time() - 5, "d")]
+        self.result(self.index.entries("crashing", fresh=True))
+        self.assertEqual([{"app": "crashing", "crashes": 3}],
+                         self.stats.top())
+
+        # the index is loaded from scratch after eviction
+        del self.index._apps["crashing"]
+        self.result(self.index.entries("crashing"))
+        self.assertEqual([{"app": "crashing", "crashes": 3}],
+                         self.stats.top())
+
+
+class BuildlogRangeTest(unittest.TestCase):
+
+    def test_parse_range(self):
+        self.assertEqual((0, 100), parse_range("bytes=0-99"))
+        self.assertEqual((100, None), parse_range("bytes=100-"))
+        self.assertEqual((-50, None), parse_range("bytes=-50"))
+        # an empty suffix is unsatisfiable
+        self.assertEqual((0, 0), parse_range("bytes=-0"))
+
+    def test_parse_invalid_range(self):
+        for header in (None, "", "bytes=-", "bytes=5-1", "bytes=0-1,5-6",
+                       "items=0-1", "bytes=a-b"):
+            self.assertIsNone(parse_range(header), header)
+
+    def test_resolve_range(self):
+        self.assertEqual((0, 100), resolve_range(100))
+        self.assertEqual((10, 100), resolve_range(100, 10))
+        self.assertEqual((10, 30), resolve_range(100, 10, 20))
+        self.assertEqual((90, 100), resolve_range(100, 90, 20))
+        self.assertEqual((100, 100), resolve_range(100, 150))
+        self.assertEqual((0, 0), resolve_range(100, 0, -5))
+        # negative offset counts from the end
+        self.assertEqual((70, 100), resolve_range(100, -30))
+        self.assertEqual((0, 100), resolve_range(100, -300))
+
+    def test_resolve_header(self):
+        self.assertEqual((70, 100),
+                         resolve_range(100, *parse_range("bytes=-30")))
+        self.assertEqual((0, 0), resolve_range(100, *parse_range("bytes=-0")))
+        self.assertEqual((90, 100),
+                         resolve_range(100, *parse_range("bytes=90-199")))
+
+
+class SegmentCompressorTest(unittest.TestCase):
+    segments = ["a" * 1000, "hello " * 300, "tail"]
+
+    def compress(self, codec):
+        compressor = SegmentCompressor(codec)
+        last = len(self.segments) - 1
+        return [compressor.segment(data, n == last)
+                for n, data in enumerate(self.segments)]
+
+    def test_segments(self):
+        for codec in (GZIP, ZLIB):
+            records = self.compress(codec)
+            self.assertEqual(self.segments,
+                             [unpack_segment(record, n)
+                              for n, record in enumerate(records)])
+
+    def test_stream(self):
+        # payloads put together make a single stream
+        for codec in (GZIP, ZLIB):
+            payload = "".join(split_header(record)[1]
+                              for record in self.compress(codec))
+            self.assertEqual("".join(self.segments),
+                             zlib.decompress(payload, WBITS[codec]))
+
+    def test_raw(self):
+        self.assertEqual("plain", unpack_segment("plain", 3))
+
+
+class BoundedMapTest(FlowToolsTestCase):
+
+    def setUp(self):
+        super(BoundedMapTest, self).setUp()
+        self.running = 0
+        self.peak = 0
+        self.started = dict()
+
+    def task(self, delays):
+        @asynchronous
+        def call(item):
+            self.started[item] = time.time()
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            try:
+                yield sleep(delays.get(item, 0.01))
+            finally:
+                self.running -= 1
+            if item == "bad":
+                raise ValueError(item)
+            yield item.upper()
+        return call
+
+    def test_limit(self):
+        items = ["a", "b", "c", "d", "e", "f", "g"]
+        # results are in the order of items, not of completion
+        delays = dict((item, 0.01 * (len(items) - n))
+                      for n, item in enumerate(items))
+        results = self.result(bounded_map(self.task(delays), items, 3))
+        self.assertEqual(["A", "B", "C", "D", "E", "F", "G"], results)
+        self.assertEqual(3, self.peak)
+        self.assertEqual(0, self.running)
+
+    def test_errors(self):
+        def call(item):
+            if item == "sync":
+                raise ValueError(item)
+            return self.task({})(item)
+
+        results = self.result(bounded_map(call, ["a", "bad", "sync"], 2))
+        self.assertEqual("A", results[0])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsInstance(results[2], ValueError)
+
+    def test_empty(self):
+        self.assertEqual([], self.result(bounded_map(self.task({}), [], 2)))
+
+    def test_timeout(self):
+        # a timed out call keeps its slot for one more timeout
+        timeout = 0.1
+        call = self.task({"slow": 1})
+        results = self.result(bounded_map(call, ["slow", "next"], 1,
+                                          timeout))
+        self.assertIsInstance(results[0], TimeoutError)
+        self.assertEqual("NEXT", results[1])
+        waited = self.started["next"] - self.started["slow"]
+        self.assertTrue(1.5 * timeout < waited < 1, waited)
+
+    def test_late_result(self):
+        # the slot is released as soon as a timed out call is over,
+        # but its late result is dropped
+        timeout = 0.1
+        call = self.task({"slow": 0.12})
+        results = self.result(bounded_map(call, ["slow", "next"], 1,
+                                          timeout))
+        self.assertIsInstance(results[0], TimeoutError)
+        self.assertEqual("NEXT", results[1])
+        waited = self.started["next"] - self.started["slow"]
+        self.assertTrue(0.12 <= waited < 2 * timeout, waited)
+
+
+class HostHealthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.health = HostHealth()
+
+    def record(self, *results):
+        for ok in results:
+            state = self.health.record(ok, None if ok else "error")
+        return state
+
+    def test_down(self):
+        self.assertEqual(health.UNKNOWN, self.health.state)
+        self.assertEqual(health.UP, self.record(True))
+        changed_at = self.health.changed_at
+
+        # single failures don't change the state
+        self.assertEqual(health.UP, self.record(False, False))
+        self.assertEqual(2, self.health.failures)
+        self.assertEqual("error", self.health.last_error)
+        self.assertEqual(changed_at, self.health.changed_at)
+
+        self.assertEqual(health.DOWN, self.record(False))
+        self.assertEqual(self.health.last_probe, self.health.changed_at)
+
+        self.assertEqual(health.UP, self.record(True))
+        self.assertEqual(0, self.health.failures)
+        self.assertIsNone(self.health.last_error)
+
+    def test_flapping(self):
+        self.assertEqual(health.UP, self.record(True, False, True, False))
+        self.assertEqual(health.FLAPPING, self.record(True))
+        # until transitions are out of the window
+        self.assertEqual(health.FLAPPING, self.record(*[True] * 5))
+        self.assertEqual(health.UP, self.record(True))
+
+
+class FakeHostDB(object):
+
+    def __init__(self, hosts):
+        self.hosts_list = hosts
+
+    def hosts(self):
+        return resolved(list(self.hosts_list))
+
+
+class FakeNodePool(object):
+
+    def __init__(self):
+        # host -> True if it's up, False if it fails, None if it hangs
+        self.states = dict()
+        self.calls = list()
+
+    def call(self, host, name, timeout, func):
+        self.calls.append(host)
+        state = self.states.get(host, True)
+        if state:
+            return resolved(True)
+        deferred = Deferred()
+        if state is False:
+            error_later(deferred, IOError("Connection refused"))
+        return deferred
+
+
+class HealthTrackerTest(FlowToolsTestCase):
+
+    def setUp(self):
+        super(HealthTrackerTest, self).setUp()
+        self.hostdb = FakeHostDB(["up", "failing", "hanging", "flapping"])
+        self.nodepool = FakeNodePool()
+        self.nodepool.states = {"failing": False, "hanging": None}
+        self.tracker = HealthTracker(self.hostdb, self.nodepool,
+                                     timeout=0.05)
+
+    def probe(self, times=1):
+        for _ in range(times):
+            self.result(self.tracker.probe())
+
+    def test_states(self):
+        self.probe()
+        self.assertEqual(health.UP, self.tracker.state("up"))
+        self.assertEqual(health.UNKNOWN, self.tracker.state("failing"))
+        self.probe(2)
+        self.assertEqual(health.DOWN, self.tracker.state("failing"))
+        self.assertEqual(health.DOWN, self.tracker.state("hanging"))
+        self.assertEqual(health.UNKNOWN, self.tracker.state("unknown"))
+
+        dump = self.tracker.dump()
+        self.assertEqual("Connection refused", dump["failing"]["last_error"])
+        self.assertEqual(3, dump["hanging"]["failures"])
+
+    def test_split(self):
+        for ok in (True, False, True, False, True):
+            self.nodepool.states["flapping"] = ok
+            self.probe()
+        self.assertEqual(health.FLAPPING, self.tracker.state("flapping"))
+        # flapping hosts go last, unknown ones are used
+        alive, down = self.tracker.split(["flapping", "hanging", "new",
+                                          "failing", "up"])
+        self.assertEqual(["new", "up", "flapping"], alive)
+        self.assertEqual(["hanging", "failing"], down)
+
+    def test_removed_host(self):
+        self.probe()
+        self.hostdb.hosts_list = ["up"]
+        self.probe()
+        self.assertEqual(["up"], list(self.tracker.dump()))
+
+
+class ResolveCountTest(unittest.TestCase):
+
+    def test_absolute(self):
+        self.assertEqual(3, resolve_count(3, 10))
+        self.assertEqual(4, resolve_count("4", 10))
+        self.assertRaises(ValueError, resolve_count, "many", 10)
+
+    def test_percent(self):
+        self.assertEqual(3, resolve_count("25%", 10))
+        self.assertEqual(7, resolve_count("100%", 7))
+        # at least one host, unless zero percent is asked
+        self.assertEqual(1, resolve_count("1%", 10))
+        self.assertEqual(0, resolve_count("0%", 10))
+
+
+class RollingStartTest(FlowToolsTestCase):
+
+    def setUp(self):
+        super(RollingStartTest, self).setUp()
+        self.hosts = ["h1", "h2", "h3", "h4", "h5"]
+        self.nodepool = FakeNodePool()
+        self.lines = list()
+        self.cluster = NodeCluster(self.hosts, self.nodepool,
+                                   self.lines.append, timeout=1)
+
+    def batches(self):
+        return [line.strip() for line in self.lines
+                if line.startswith("Start batch")]
+
+    def test_batches(self):
+        started = time.time()
+        result = self.result(self.cluster.rolling_start_app(
+            "testapp", "default", 2, pause=0.1))
+        self.assertEqual((self.hosts, [], []), tuple(result))
+        self.assertEqual(["Start batch 1/3 of 2 hosts",
+                          "Start batch 2/3 of 2 hosts",
+                          "Start batch 3/3 of 1 hosts"], self.batches())
+        self.assertEqual(self.hosts, self.nodepool.calls)
+        # no pause after the last batch
+        self.assertTrue(0.2 <= time.time() - started < 0.3)
+
+    def test_max_failed(self):
+        self.nodepool.states = {"h2": False, "h3": False}
+        result = self.result(self.cluster.rolling_start_app(
+            "testapp", "default", 2, max_failed=1))
+        self.assertEqual((["h1", "h4"], ["h2", "h3"], ["h5"]), tuple(result))
+        self.assertEqual(2, len(self.batches()))
+        self.assertEqual(["h1", "h2", "h3", "h4"], self.nodepool.calls)
+
+    def test_batch_size(self):
+        result = self.result(self.cluster.rolling_start_app(
+            "testapp", "default", 0))
+        self.assertEqual(self.hosts, result[0])
+        self.assertEqual(5, len(self.batches()))